@@ -0,0 +1,51 @@
+import os
+import select
+import socket
+
+from config.utils import EVENTS_SOCKET_PATH
+
+NEW_READINGS = b"new-readings"
+
+
+def publish(message: bytes = NEW_READINGS, path: str = EVENTS_SOCKET_PATH):
+    """
+    Fire and forget datagram to whoever is subscribed.
+    Nobody listening is fine, subscribers keep a fallback timer for lost signals.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(message, path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    except OSError as exc:
+        print(f"Could not publish {message}: {exc}")
+
+
+class Subscriber:
+    """Receiving end of `publish`, a unix datagram socket bound at `path`."""
+    def __init__(self, path: str = EVENTS_SOCKET_PATH):
+        self.path = path
+        if os.path.exists(path):
+            # left behind by a previous run that did not shut down cleanly
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+
+    def wait(self, timeout: float) -> bool:
+        """Blocks until something is published or `timeout` seconds pass, returns whether it was woken up."""
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return False
+        # several commits may have landed while we were busy, one wake up covers them all
+        while True:
+            try:
+                self.sock.recv(1024)
+            except BlockingIOError:
+                return True
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
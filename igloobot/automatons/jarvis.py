@@ -1,9 +1,12 @@
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
 import telebot
 
 from intelligence.recorder import record_insu, record_food, record_misc
 from config.constants import REGULAR_BOT_TOKEN as BOT_TOKEN
-from config.utils import get_current_time
-from intelligence.plotting_utils import plot_default
+from config.utils import get_current_time, DEFAULT_AGP_DAYS, DEFAULT_RANGE_DAYS
+from intelligence.render_service import get_render_service, RenderQueueFull
 
 # Initialize the bot
 bot = telebot.TeleBot(BOT_TOKEN)
@@ -13,6 +16,8 @@ enter_insulin = 'e:insu'
 enter_food = 'e:food'
 enter_misc = 'e:misc'
 get_plot = 'g:plot'
+get_agp = 'g:agp'
+get_range = 'g:days'
 # get_plot_for_ts = 'g:plot(ts)'
 # get_plot_for_food = 'g:plot(food)'
 
@@ -23,6 +28,8 @@ keyboard.add(
     telebot.types.KeyboardButton(enter_food),
     telebot.types.KeyboardButton(enter_misc),
     telebot.types.KeyboardButton(get_plot),
+    telebot.types.KeyboardButton(get_agp),
+    telebot.types.KeyboardButton(get_range),
     # telebot.types.KeyboardButton(get_plot_for_ts),
     # telebot.types.KeyboardButton(get_plot_for_food)
 )
@@ -66,12 +73,67 @@ def handle_get_plot(message):
     global current_input_key
     current_input_key = get_plot
     bot.send_message(chat_id=message.chat.id, text="Generating plot...")
-    im_path = plot_default()
+    send_render(message.chat.id, "plot_default")
+
+
+def send_render(chat_id, job: str, empty_text: str = "Plot cannot be created : no data in requested time range",
+                **kwargs):
+    """Queues the render and returns right away, the image is sent from a delivery thread once it is done."""
+    render_service = get_render_service()
+    try:
+        future = render_service.submit(job, **kwargs)
+    except RenderQueueFull:
+        bot.send_message(chat_id=chat_id, text="Too many plots pending, try again in a bit")
+        return
+    render_service.deliver(future, lambda done: deliver_render(chat_id, done, empty_text))
+
+
+def deliver_render(chat_id, future: Future, empty_text: str):
     try:
-        with open(im_path, 'rb') as photo:
-            bot.send_photo(chat_id=message.chat.id, photo=photo)
+        image = future.result()
+        if image is None:
+            bot.send_message(chat_id=chat_id, text=empty_text)
+            return
+        bot.send_photo(chat_id=chat_id, photo=image)
     except Exception as exc:
-        bot.send_message(chat_id=message.chat.id, text=f"Plot cannot be created : {exc}")
+        bot.send_message(chat_id=chat_id, text=f"Plot cannot be created : {exc}")
+
+
+@bot.message_handler(func=lambda message: message.text == get_agp)
+def handle_get_agp(message):
+    print(f"called {message.text}")
+    global current_input_key
+    current_input_key = get_agp
+    bot.send_message(chat_id=message.chat.id,
+                     text=f"Please enter a number of days, or 'yyyy-mm-dd yyyy-mm-dd' (default {DEFAULT_AGP_DAYS}) >>")
+
+
+@bot.message_handler(func=lambda message: message.text == get_range)
+def handle_get_range(message):
+    print(f"called {message.text}")
+    global current_input_key
+    current_input_key = get_range
+    bot.send_message(chat_id=message.chat.id,
+                     text=f"Please enter a number of days, or 'yyyy-mm-dd yyyy-mm-dd' (default {DEFAULT_RANGE_DAYS}) >>")
+
+
+def parse_range(range_text: str, default_days: int) -> dict:
+    """Plot arguments for either a number of days or a 'yyyy-mm-dd yyyy-mm-dd' range, both days included."""
+    range_parts = range_text.split()
+    if len(range_parts) == 2:
+        start, end = (datetime.strptime(part, '%Y-%m-%d') for part in range_parts)
+        return {"start": start, "end": end + timedelta(days=1) - timedelta(minutes=1)}
+    return {"days": int(range_text) if range_text.strip() else default_days}
+
+
+def send_agp(chat_id, range_text: str):
+    send_render(chat_id, "plot_agp", empty_text="No readings in that range",
+                **parse_range(range_text, DEFAULT_AGP_DAYS))
+
+
+def send_range(chat_id, range_text: str):
+    send_render(chat_id, "plot_range", empty_text="No readings in that range",
+                **parse_range(range_text, DEFAULT_RANGE_DAYS))
 
 
 # @bot.message_handler(func=lambda message: message.text == get_plot_for_food)
@@ -112,6 +174,14 @@ def handle_value(message):
         elif current_input_key == get_plot:
             # does not need any values
             pass
+        elif current_input_key == get_agp:
+            print(current_input_key, current_inputs_value)
+            bot.send_message(chat_id=chat_id, text="Generating AGP...")
+            send_agp(chat_id, current_inputs_value)
+        elif current_input_key == get_range:
+            print(current_input_key, current_inputs_value)
+            bot.send_message(chat_id=chat_id, text="Generating plot...")
+            send_range(chat_id, current_inputs_value)
         # elif current_input_key == get_plot_for_food:
         #     print(current_input_key, current_inputs_value)
         # elif current_input_key == get_plot_for_ts:
@@ -122,6 +192,7 @@ def handle_value(message):
 
 
 def poll():
+    get_render_service().warm()
     bot.polling()
 
 
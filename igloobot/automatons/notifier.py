@@ -1,18 +1,20 @@
-import time
 from dataclasses import dataclass, field
 
 import telebot
-import threading
 
+from automatons.channel import Subscriber
 from config.constants import SELECT_BOT_TOKEN, CHAT_ID, REGULAR_BOT_TOKEN
-from config.utils import is_high, is_very_high, is_very_low, get_current_time
-from datastore.primitives import SqliteDatabase
-from intelligence.plotting_utils import plot_default
+from config.utils import is_high, is_very_high, is_very_low, get_current_time, PLOT_PRERENDER
+from datastore.primitives import get_database
 from intelligence.primitives import DataProcessor
+from intelligence.render_service import get_render_service, RenderQueueFull
+from intelligence.ringbuffer import ReadingsRingBuffer
 
 SECONDS = 1
 MINS = 60 * SECONDS
+# the populator signals new readings, polling is only the fallback if a signal is lost
 POLL_INTERVAL = 1 * MINS
+PLOT_DELIVERY_MINUTES = [5, 35]
 
 select_bot = telebot.TeleBot(SELECT_BOT_TOKEN)
 regular_bot = telebot.TeleBot(REGULAR_BOT_TOKEN)
@@ -23,10 +25,11 @@ def send_message(message_text, bot_var=regular_bot):
     if message_text:
         bot_var.send_message(chat_id=CHAT_ID, text=message_text)
 
-def send_photo(im_path, bot_var=regular_bot):
+def send_photo(image, bot_var=regular_bot):
     try:
-        with open(im_path, 'rb') as photo:
-            bot_var.send_photo(chat_id=CHAT_ID, photo=photo)
+        if image is None:
+            raise ValueError("no data in requested time range")
+        bot_var.send_photo(chat_id=CHAT_ID, photo=image)
     except Exception as exc:
         bot_var.send_message(chat_id=CHAT_ID, text=f"Plot cannot be created : {exc}")
 
@@ -64,19 +67,49 @@ class NotifState:
         return f"{self.curr_val} to {self.proj_val}, {self.curr_velo:.2f}/min"
 
 def automatic_plot_delivery():
+    # rendered in the render service, the alert loop carries on meanwhile
+    try:
+        render_service = get_render_service()
+        render_service.deliver(render_service.plot_default(), deliver_plot)
+    except Exception as exc:
+        send_message(f"Plot cannot be created : {exc}")
+
+def deliver_plot(future):
     send_message("Plot Delivery Requested")
-    im_path = plot_default()
-    send_photo(im_path)
+    try:
+        image = future.result()
+    except Exception as exc:
+        send_message(f"Plot cannot be created : {exc}")
+        return
+    send_photo(image)
+
+def prerender_plot():
+    # fills the plot cache in a render worker, the next /plot or delivery is served from it
+    try:
+        get_render_service().prerender_default_plot()
+    except RenderQueueFull as exc:
+        print(f"Skipped pre-rendering the default plot, {exc.message}")
 
 def run():
     prev_state = NotifState()
-    sqldb = SqliteDatabase()
+    sqldb = get_database()
+    get_render_service().warm()
+    buffer = ReadingsRingBuffer.load(sqldb, until=get_current_time())
+    subscriber = Subscriber()
+    last_plot_slot = None
     while True:
         try:
             current_time = get_current_time()
-            if current_time.minute in [5, 35]:
-                threading.Thread(target=automatic_plot_delivery).start()
-            pr = DataProcessor(sqldb=sqldb, end_datetime=current_time)
+            plot_slot = current_time.replace(second=0, microsecond=0)
+            # woken up by the populator and the timer, deliver once per slot
+            delivering = current_time.minute in PLOT_DELIVERY_MINUTES and plot_slot != last_plot_slot
+            if delivering:
+                last_plot_slot = plot_slot
+                automatic_plot_delivery()
+            # new readings or notes were committed, unless a delivery is rendering the same plot already
+            if buffer.refresh(sqldb) and PLOT_PRERENDER and not delivering:
+                prerender_plot()
+            pr = DataProcessor(sqldb=sqldb, end_datetime=current_time, buffer=buffer)
 
             curr_state = NotifState(
                 pr.present_reading,
@@ -92,9 +125,10 @@ def run():
                     send_message(message_text=curr_state.str(), bot_var=select_bot)
 
             prev_state = curr_state
-            time.sleep(POLL_INTERVAL)
+            subscriber.wait(timeout=POLL_INTERVAL)
         except Exception as exd:
             print(f"Processing failed. Exception = {exd}")
+            subscriber.close()
             raise
 
 
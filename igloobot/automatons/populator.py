@@ -1,11 +1,17 @@
+import copy
 import datetime
-import sqlite3
 import subprocess
 import time
+from typing import Dict
 
-from config.utils import TIMESTAMP_FORMAT
-from datastore.primitives import SqliteDatabase, IglooDataElement, IglooUpdatesElement
-from intelligence.primitives import DataProcessor
+from automatons import channel
+from config.utils import TIMESTAMP_FORMAT, get_current_time, from_epoch_minutes, PROJECTION_METHOD, PROJECTION_STREAMING
+from datastore.columnar import to_datetimes
+from datastore.primitives import SqliteDatabase, get_database, IglooDataElement, IglooUpdatesElement
+from intelligence.estimator import StreamingTrendEstimator
+from intelligence.meals import update_meal_responses
+from intelligence.projection import DEFAULT_MINS_IN_PAST, project_columns
+from intelligence.ringbuffer import ReadingsRingBuffer
 from libre.primitives import LibreManager
 
 MINS = 60
@@ -26,28 +32,108 @@ Needs further thought, in case there are more than one values separated by 1 min
 """
 
 
+def ingest_readings(sqldb: SqliteDatabase, readings: Dict[datetime.datetime, int], buffer: ReadingsRingBuffer = None,
+                    estimator: StreamingTrendEstimator = None) -> int:
+    """
+    Writes a batch of readings along with their projections in a single transaction.
+    All new readings are projected in one pass, each one only looking back at readings up to itself.
+    With a buffer, recent readings are checked and projected from memory, so a steady state batch reads nothing
+    from the db. The buffer is brought up to date once the batch is committed, so it never holds readings a rolled
+    back transaction did not store.
+    With an estimator, readings newer than everything it has seen are projected by it instead, in O(1) each.
+    """
+    new_elems = {}
+    for ts, val in sorted(readings.items()):
+        new_elem = IglooDataElement(timestamp=ts, reading_now=val)
+        new_elems.setdefault(new_elem.timestamp, new_elem)
+
+    first_ts, last_ts = min(new_elems), max(new_elems)
+    if buffer is not None and buffer.covers(first_ts):
+        existing_ts = to_datetimes(buffer.columns(ts_start=first_ts, ts_end=last_ts).timestamp)
+    else:
+        existing_ts = [el.timestamp for el in sqldb.main_table.fetch_w_ts_range(ts_start=first_ts, ts_end=last_ts)]
+    for ts in existing_ts:
+        if new_elems.pop(ts, None):
+            print(f"{ts} already present. skipping update...")
+    if not new_elems:
+        return 0
+
+    new_elems_min = [new_elem.timestamp_min for new_elem in new_elems.values()]
+    streamed = estimator is not None and (estimator.latest_ts is None or min(new_elems_min) > estimator.latest_ts)
+    reseed_columns = None
+    with sqldb.transaction():
+        sqldb.main_table.insert_many(list(new_elems.values()))
+        sqldb.rollups_table.add_readings(new_elems_min, [new_elem.reading_now for new_elem in new_elems.values()])
+        if streamed:
+            # projected by a copy, like the buffer the estimator only takes the batch once it is committed
+            staged = copy.deepcopy(estimator)
+            projections = []
+            for new_elem in new_elems.values():
+                staged.update(new_elem.timestamp_min, new_elem.reading_now)
+                projections.append(staged.projected_with_velocity())
+            reading_20, velocity = zip(*projections)
+        else:
+            # late readings, or no estimator, go through the windowed projection
+            window_start = min(new_elems) - datetime.timedelta(minutes=DEFAULT_MINS_IN_PAST)
+            if buffer is not None and buffer.covers(window_start):
+                # the buffer only gets this batch after the commit, so it is added to the window here
+                columns = buffer.columns(ts_start=window_start, ts_end=max(new_elems)).with_readings(
+                    new_elems_min, [new_elem.reading_now for new_elem in new_elems.values()]
+                )
+            else:
+                # the db already holds this batch inside the transaction
+                columns = sqldb.main_table.fetch_columns(ts_start=window_start, ts_end=max(new_elems))
+            reading_20, velocity = project_columns(columns, ref_ts=new_elems_min)
+            if estimator is not None and max(new_elems_min) > (estimator.latest_ts or 0):
+                reseed_columns = columns
+        for new_elem, elem_reading_20, elem_velocity in zip(new_elems.values(), reading_20, velocity):
+            new_elem.reading_20 = int(elem_reading_20)
+            new_elem.velocity = float(elem_velocity)
+            print(f"Computed {new_elem}")
+        sqldb.main_table.upsert_many(list(new_elems.values()))
+    if buffer is not None:
+        for new_elem in new_elems.values():
+            buffer.append(new_elem.timestamp_min, new_elem.reading_now, new_elem.reading_20, new_elem.velocity)
+    if streamed:
+        for new_elem in new_elems.values():
+            estimator.update(new_elem.timestamp_min, new_elem.reading_now)
+    elif reseed_columns is not None:
+        estimator.reseed(reseed_columns)
+    print(f"update done.")
+    print(f"--------")
+    return len(new_elems)
+
+
+def load_estimator(buffer: ReadingsRingBuffer) -> StreamingTrendEstimator:
+    """The checkpointed estimator if it is caught up with the stored readings, rebuilt from the buffer otherwise."""
+    estimator = StreamingTrendEstimator.load()
+    if estimator is None or estimator.latest_ts != buffer.latest_ts:
+        if buffer.latest_ts is None:
+            return StreamingTrendEstimator()
+        print("Estimator checkpoint is stale, rebuilding it from recent readings.")
+        latest = from_epoch_minutes(buffer.latest_ts)
+        recent = buffer.columns(ts_start=latest - datetime.timedelta(minutes=DEFAULT_MINS_IN_PAST), ts_end=latest)
+        estimator = StreamingTrendEstimator.from_columns(recent)
+    return estimator
+
+
 def run():
-    libre_manager = LibreManager()
-    sqldb = SqliteDatabase()
+    sqldb = get_database()
+    # restarts resume from what is already stored instead of re-sending the whole 12h graph
+    libre_manager = LibreManager(watermark=sqldb.main_table.fetch_latest_timestamp())
+    buffer = ReadingsRingBuffer.load(sqldb, until=get_current_time())
+    estimator = load_estimator(buffer) if PROJECTION_METHOD == PROJECTION_STREAMING else None
     while True:
         try:
             libre_manager.update_data_state()
             new_readings = libre_manager.new_readings
-            for ts, val in new_readings.items():
-                new_elem = IglooDataElement(timestamp=ts, reading_now=val)
-                try:
-                    sqldb.main_table.insert_element(new_elem)
-
-                    data_processor = DataProcessor(sqldb=sqldb, end_datetime=ts)
-                    new_elem.reading_20 = data_processor.projected_reading
-                    new_elem.velocity = data_processor.present_velocity
-
-                    sqldb.main_table.update_computed_vals(new_elem)
-                    print(f"update done.")
-                except sqlite3.IntegrityError:
-                    print(f"integrity error. skipping update...")
-                finally:
-                    print(f"--------")
+            if new_readings and ingest_readings(sqldb, new_readings, buffer=buffer, estimator=estimator):
+                # wake the notifier up right away instead of at its next poll
+                channel.publish()
+                if estimator is not None:
+                    estimator.save()
+                update_meal_responses(sqldb)
+            libre_manager.advance_watermark(new_readings)
 
             time.sleep(POLL_INTERVAL)
         except Exception as exd:
@@ -1,4 +1,5 @@
 import os
+from typing import Dict, Tuple
 
 import numpy as np
 import datetime
@@ -10,8 +11,71 @@ os.makedirs(DS_DATA_DIR, exist_ok=True)
 DS_FILE_NAME = "igloo-database.sqlite"
 IDATA_TABLE_NAME = "igloo_data"
 UPDATES_DATA_TABLE = "igloo_updates_data"
+INSULIN_EVENTS_TABLE = "igloo_insulin_events"
+# full text index over the notes of UPDATES_DATA_TABLE, its rowid is the updates timestamp
+UPDATES_FTS_TABLE = "igloo_updates_fts"
+# glucose response metrics per food note, kept up to date by the populator
+MEAL_RESPONSES_TABLE = "igloo_meal_responses"
+# count/sum/sumsq/min/max and range counts of the readings, per bucket of each of ROLLUP_RESOLUTIONS
+ROLLUPS_TABLE = "igloo_rollups"
+ROLLUP_RESOLUTIONS = (5, 60, 24 * 60)  # mins, the daily buckets start at local midnight
+# populator -> notifier signal, sent after new readings are committed
+EVENTS_SOCKET_PATH = os.path.normpath(os.path.join(DS_DATA_DIR, "igloo-events.sock"))
+# libre auth ticket, kept across restarts until it expires
+LIBRE_TOKEN_CACHE_PATH = os.path.normpath(os.path.join(DS_DATA_DIR, "libre-token.json"))
+# streaming projection state, lets the populator resume without re-reading history
+ESTIMATOR_STATE_PATH = os.path.normpath(os.path.join(DS_DATA_DIR, "estimator-state.json"))
+# rendered plots, shared by every process. the notifier has its render workers pre-render the default plot
+# whenever new readings or notes are committed, so the populator never loads matplotlib or pandas
+PLOT_CACHE_DIR = os.path.normpath(os.path.join(DS_DATA_DIR, "plot-cache"))
+PLOT_CACHE_MAX_ENTRIES = 32
+PLOT_PRERENDER = True
+# worker processes plots are rendered in, and how many renders may be waiting for them
+RENDER_WORKERS = 2
+RENDER_QUEUE_SIZE = 8
+# threads finished renders are sent to telegram from, off the render pool's result thread
+RENDER_DELIVERY_THREADS = 2
+
+# applied to every pooled sqlite connection
+DS_CACHED_STATEMENTS = 128
+DS_PRAGMAS = {
+    "journal_mode": "WAL",
+    "busy_timeout": 6000,  # ms, SQLite retries a locked DB for up to this long
+    "synchronous": "NORMAL",  # safe with WAL, skips an fsync per commit
+    "cache_size": -8000,  # negative is KiB, ~8MB page cache
+    "mmap_size": 64 * 1024 * 1024,
+}
+# rows copied per transaction by schema migrations, small enough for writers to interleave
+DS_MIGRATION_BATCH_SIZE = 5000
 
 TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M"
+# timestamps are stored as whole minutes since EPOCH, of the local wall clock time
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# insulin is stored as one event per dose, and expanded into insulin-on-board while reading
+INSULIN_PROFILE_FLAT = "flat"  # full dose active for LEGACY_INSULIN_SPREAD_MINS, what record_insu used to write
+INSULIN_PROFILE_LINEAR = "linear"
+DEFAULT_INSULIN_PROFILE = INSULIN_PROFILE_FLAT
+LEGACY_INSULIN_SPREAD_MINS = 120
+
+# window a meal is judged over, the baseline is the last reading in MEAL_BASELINE_MINS before it
+MEAL_BASELINE_MINS = 30
+MEAL_RESPONSE_MINS = 4 * 60
+# meals the populator keeps up to date after each insert, older ones are filled in by --backfill-meal-responses
+MEAL_PENDING_LOOKBACK_MINS = 24 * 60
+# meals computed per transaction by the backfill
+MEAL_BACKFILL_BATCH_SIZE = 200
+
+# how the populator projects reading_20, averaged windowed slopes or a streaming least squares fit
+PROJECTION_WINDOWED = "windowed"
+PROJECTION_STREAMING = "streaming"
+PROJECTION_METHOD = PROJECTION_WINDOWED
+
+# plots are rendered in memory and sent as they are, the preset sets their resolution and encoding
+PLOT_PRESET = "mobile"
+# days the AGP and range plots cover when none are asked for
+DEFAULT_AGP_DAYS = 14
+DEFAULT_RANGE_DAYS = 7
 
 VAL_PROJECTED = "Projected"
 VAL_CURRENT = "Current"
@@ -29,6 +93,11 @@ GLU_RANGES = {
     4: H_RANGE,
     5: VH_RANGE
 }
+GLU_VERY_LOW, GLU_LOW, GLU_IN_RANGE, GLU_HIGH, GLU_VERY_HIGH = GLU_RANGES
+# lower bounds of GLU_RANGES 2 to 5, values below the first are very low and the last range has no upper bound.
+# unlike membership in the arange()s, readings of 500 and above (the sensor's "HI") count as very high, and
+# fractional values such as projections fall in the range whose bounds contain them
+GLU_RANGE_EDGES = np.array([L_RANGE[0], IN_RANGE[0], H_RANGE[0], VH_RANGE[0]])
 
 TIMEZONE_DIFF_MAP = {
     "INDIA": datetime.timezone(datetime.timedelta(hours=5, minutes=30)),
@@ -41,28 +110,62 @@ def get_current_time():
     current_time = datetime.datetime.now(tz_diff)
     return current_time
 
+def to_epoch_minutes(ts: datetime.datetime) -> int:
+    return (ts.replace(tzinfo=None, second=0, microsecond=0) - EPOCH) // datetime.timedelta(minutes=1)
+
+def from_epoch_minutes(minutes: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(minutes=minutes)
+
+def classify_glu_ranges(values) -> np.ndarray:
+    """GLU_RANGES id of every value, in one pass over the whole array. Every value gets one, see GLU_RANGE_EDGES."""
+    return np.searchsorted(GLU_RANGE_EDGES, np.asarray(values), side="right") + 1
+
+
+def out_of_range_mask(values, value_type: str) -> np.ndarray:
+    range_ids = classify_glu_ranges(values)
+    if value_type == VAL_PROJECTED:
+        return (range_ids == GLU_VERY_LOW) | (range_ids == GLU_VERY_HIGH)
+    return range_ids != GLU_IN_RANGE
+
+
+def range_percentages(values) -> Dict[int, float]:
+    """Share of the readings falling in each of GLU_RANGES, in percent."""
+    range_ids = classify_glu_ranges(values)
+    counts = np.bincount(range_ids, minlength=len(GLU_RANGES) + 1)[1:]
+    total = max(len(range_ids), 1)
+    return {range_id: 100 * count / total for range_id, count in zip(GLU_RANGES, counts.tolist())}
+
+
+def time_in_range(values) -> Tuple[float, float, float]:
+    """(below, in range, above) percentages of the readings."""
+    pct = range_percentages(values)
+    return pct[GLU_VERY_LOW] + pct[GLU_LOW], pct[GLU_IN_RANGE], pct[GLU_HIGH] + pct[GLU_VERY_HIGH]
+
+
+def excursion_runs(mask) -> Tuple[np.ndarray, np.ndarray]:
+    """(start index, length) of every run of consecutive True values, e.g. of an out_of_range_mask."""
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return starts, ends - starts
+
+
 def get_glu_range_id(value: int):
-    for k, v in GLU_RANGES.items():
-        if value in v:
-            return k
+    return int(classify_glu_ranges(value))
 
 
 def is_out_of_range(value: int, value_type: str):
-    if value_type == VAL_PROJECTED:
-        return value not in np.hstack((L_RANGE, IN_RANGE, H_RANGE))
-    else:
-        return value not in IN_RANGE
+    return bool(out_of_range_mask(value, value_type))
 
 
 def is_high(value: int):
-    return value in H_RANGE or value in VH_RANGE
+    return get_glu_range_id(value) >= GLU_HIGH
 
 def is_very_high(value: int):
-    return value in VH_RANGE
+    return get_glu_range_id(value) == GLU_VERY_HIGH
 
 
 def is_low(value: int):
-    return value in L_RANGE
+    return get_glu_range_id(value) == GLU_LOW
 
 def is_very_low(value: int):
-    return value in VL_RANGE
+    return get_glu_range_id(value) == GLU_VERY_LOW
@@ -0,0 +1,195 @@
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from typing import Sequence
+
+import numpy as np
+
+TIMESTAMP_DTYPE = "datetime64[m]"
+# GLU_RANGES in order, as rollup columns
+RANGE_COUNT_NAMES = ("very_low", "low", "in_range", "high", "very_high")
+
+
+def decode_timestamps(values: Sequence[int]) -> np.ndarray:
+    """Stored epoch minutes into datetime64[m], which shares the same epoch and unit, so this is only a cast."""
+    return np.asarray(values, dtype=np.int64).astype(TIMESTAMP_DTYPE)
+
+
+def to_datetimes(timestamps: np.ndarray) -> np.ndarray:
+    """datetime64 array back into naive datetime objects."""
+    return timestamps.astype("datetime64[s]").astype(datetime)
+
+
+def to_datetime64(ts: datetime) -> np.datetime64:
+    return np.datetime64(ts.replace(tzinfo=None, second=0, microsecond=0), "m")
+
+
+class _Columns:
+    """Shared helpers for the columnar fetch results, columns are kept in ascending timestamp order."""
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def to_frame(self):
+        # pandas is only needed by the callers that want a DataFrame, keep it off the import path of the rest
+        import pandas as pd
+        frame = pd.DataFrame({f.name: getattr(self, f.name) for f in fields(self)})
+        frame["timestamp"] = frame["timestamp"].astype("datetime64[ns]")
+        return frame
+
+    def window(self, ts_start: np.datetime64, ts_end: np.datetime64):
+        lo = np.searchsorted(self.timestamp, ts_start, side="left")
+        hi = np.searchsorted(self.timestamp, ts_end, side="right")
+        return type(self)(**{f.name: getattr(self, f.name)[lo:hi] for f in fields(self)})
+
+
+@dataclass
+class ReadingColumns(_Columns):
+    timestamp: np.ndarray = field(default_factory=lambda: np.array([], dtype=TIMESTAMP_DTYPE))
+    reading_now: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    reading_20: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.float64))
+    velocity: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.float64))
+
+    @classmethod
+    def from_records(cls, records):
+        if not records:
+            return cls()
+        ts, reading_now, reading_20, velocity = zip(*records)
+        return cls(
+            timestamp=decode_timestamps(ts),
+            reading_now=np.array(reading_now, dtype=np.int64),
+            reading_20=np.array(reading_20, dtype=np.float64),
+            velocity=np.array(velocity, dtype=np.float64),
+        )
+
+    def with_readings(self, ts_min: Sequence[int], reading_now: Sequence[int]) -> "ReadingColumns":
+        """Adds readings at epoch minutes not in the columns yet, with nothing computed for them, keeping the order."""
+        timestamp = np.concatenate((self.timestamp, decode_timestamps(ts_min)))
+        order = np.argsort(timestamp, kind="stable")
+        return ReadingColumns(
+            timestamp=timestamp[order],
+            reading_now=np.concatenate((self.reading_now, np.asarray(reading_now, dtype=np.int64)))[order],
+            reading_20=np.concatenate((self.reading_20, np.zeros(len(ts_min))))[order],
+            velocity=np.concatenate((self.velocity, np.zeros(len(ts_min))))[order],
+        )
+
+
+@dataclass
+class UpdatesColumns(_Columns):
+    timestamp: np.ndarray = field(default_factory=lambda: np.array([], dtype=TIMESTAMP_DTYPE))
+    food_note: np.ndarray = field(default_factory=lambda: np.array([], dtype=object))
+    misc_note: np.ndarray = field(default_factory=lambda: np.array([], dtype=object))
+    upd_rowid: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+
+    @classmethod
+    def from_records(cls, records):
+        if not records:
+            return cls()
+        ts, food_note, misc_note, upd_rowid = zip(*records)
+        return cls(
+            timestamp=decode_timestamps(ts),
+            food_note=np.array(food_note, dtype=object),
+            misc_note=np.array(misc_note, dtype=object),
+            upd_rowid=np.array(upd_rowid, dtype=np.int64),
+        )
+
+
+@dataclass
+class RollupColumns(_Columns):
+    """Rollup buckets of one resolution, timestamp being the start of each bucket."""
+    timestamp: np.ndarray = field(default_factory=lambda: np.array([], dtype=TIMESTAMP_DTYPE))
+    count: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    sum: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    sumsq: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    min: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    max: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    # readings per GLU_RANGES id, shaped (buckets, 5)
+    range_counts: np.ndarray = field(default_factory=lambda: np.zeros((0, 5), dtype=np.int64))
+
+    @classmethod
+    def from_records(cls, records):
+        if not records:
+            return cls()
+        columns = np.array(records, dtype=np.int64)
+        return cls(
+            timestamp=decode_timestamps(columns[:, 0]),
+            count=columns[:, 1], sum=columns[:, 2], sumsq=columns[:, 3], min=columns[:, 4], max=columns[:, 5],
+            range_counts=columns[:, 6:],
+        )
+
+    def to_frame(self):
+        import pandas as pd
+        frame = pd.DataFrame({f.name: getattr(self, f.name) for f in fields(self) if f.name != "range_counts"})
+        frame["timestamp"] = frame["timestamp"].astype("datetime64[ns]")
+        for idx, name in enumerate(RANGE_COUNT_NAMES):
+            frame[name] = self.range_counts[:, idx]
+        return frame
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.sum / np.maximum(self.count, 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(np.maximum(self.sumsq / np.maximum(self.count, 1) - self.mean ** 2, 0))
+
+    @property
+    def gmi(self) -> np.ndarray:
+        """Glucose management indicator (estimated A1c, %) from the mean in mg/dL."""
+        return 3.31 + 0.02392 * self.mean
+
+    @property
+    def range_percentages(self) -> np.ndarray:
+        return 100 * self.range_counts / np.maximum(self.count, 1)[:, None]
+
+    def total(self) -> "RollupColumns":
+        """All buckets folded into one, e.g. the days of a month into the month."""
+        if not len(self):
+            return type(self)()
+        return type(self)(
+            timestamp=self.timestamp[:1], count=self.count.sum(keepdims=True), sum=self.sum.sum(keepdims=True),
+            sumsq=self.sumsq.sum(keepdims=True), min=self.min.min(keepdims=True), max=self.max.max(keepdims=True),
+            range_counts=self.range_counts.sum(axis=0, keepdims=True),
+        )
+
+
+@dataclass
+class TimelineColumns(_Columns):
+    """Readings and notes merged on timestamp, zeros and empty notes where a minute only has one of them."""
+    timestamp: np.ndarray = field(default_factory=lambda: np.array([], dtype=TIMESTAMP_DTYPE))
+    reading_now: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    reading_20: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.float64))
+    velocity: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.float64))
+    food_note: np.ndarray = field(default_factory=lambda: np.array([], dtype=object))
+    misc_note: np.ndarray = field(default_factory=lambda: np.array([], dtype=object))
+    upd_rowid: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    ins_units: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.float64))
+
+    @classmethod
+    def from_records(cls, records):
+        if not records:
+            return cls()
+        ts, reading_now, reading_20, velocity, food_note, misc_note, upd_rowid = zip(*records)
+        return cls(
+            timestamp=decode_timestamps(ts),
+            reading_now=np.array(reading_now, dtype=np.int64),
+            reading_20=np.array(reading_20, dtype=np.float64),
+            velocity=np.array(velocity, dtype=np.float64),
+            food_note=np.array(food_note, dtype=object),
+            misc_note=np.array(misc_note, dtype=object),
+            upd_rowid=np.array(upd_rowid, dtype=np.int64),
+            ins_units=np.zeros(len(ts)),
+        )
+
+    def with_timestamps(self, timestamps: np.ndarray) -> "TimelineColumns":
+        """Adds empty rows for the given timestamps that are not in the timeline yet, keeping the order."""
+        new_ts = np.setdiff1d(timestamps, self.timestamp)
+        if not len(new_ts):
+            return self
+        order = np.argsort(np.concatenate((self.timestamp, new_ts)), kind="stable")
+        merged = {}
+        for f in fields(self):
+            column = getattr(self, f.name)
+            filler = new_ts if f.name == "timestamp" else np.full(len(new_ts), "" if column.dtype == object else 0,
+                                                                  dtype=column.dtype)
+            merged[f.name] = np.concatenate((column, filler))[order]
+        return type(self)(**merged)
@@ -0,0 +1,311 @@
+"""
+Schema versions are tracked with PRAGMA user_version.
+A brand new database is created straight at SCHEMA_VERSION by the table classes,
+an existing one is brought up to it by running every migration above its current version, in order.
+Migrations work on raw table names and SQL, they must not depend on the current table classes.
+"""
+import fcntl
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from config.utils import IDATA_TABLE_NAME, UPDATES_DATA_TABLE, INSULIN_EVENTS_TABLE, TIMESTAMP_FORMAT, \
+    DEFAULT_INSULIN_PROFILE, LEGACY_INSULIN_SPREAD_MINS, DS_MIGRATION_BATCH_SIZE, UPDATES_FTS_TABLE
+from datastore.rollups import create_rollups_table, rebuild_rollups
+
+# 'YYYY-mm-dd HH:MM' text into epoch minutes, strftime('%s') reads it as UTC which is exactly our encoding
+TEXT_TS_TO_MINUTES = "CAST(strftime('%s', substr({src}timestamp, 1, 16)) AS INTEGER) / 60"
+
+
+def _table_exists(db, tablename: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;"
+    return db.execute_query(query, (tablename,)).fetchone() is not None
+
+
+def _column_type(db, tablename: str, column: str) -> str:
+    for _, name, col_type, *_ in db.execute_query(f"PRAGMA table_info({tablename});").fetchall():
+        if name == column:
+            return col_type.upper()
+    return ""
+
+
+def migrate_v1_insulin_events(db, batch_size: int):
+    """
+    Older versions of record_insu added each dose to ins_units of the next LEGACY_INSULIN_SPREAD_MINS rows
+    of the updates table. Recovers the doses from those rows as dose[t] = ins[t] - ins[t-1] + dose[t-spread],
+    stores them as insulin events and clears the rows that only carried insulin.
+    """
+    if not _table_exists(db, UPDATES_DATA_TABLE):
+        return
+    db.execute_query(f'''
+        CREATE TABLE IF NOT EXISTS {INSULIN_EVENTS_TABLE} (
+            timestamp TEXT NOT NULL,
+            units REAL NOT NULL,
+            profile TEXT NOT NULL DEFAULT '{DEFAULT_INSULIN_PROFILE}'
+        );
+        ''')
+    records = db.execute_query(f'''
+        SELECT substr(timestamp, 1, 16), ins_units FROM {UPDATES_DATA_TABLE}
+         WHERE typeof(ins_units) IN ('integer', 'real') AND ins_units != 0
+         ORDER BY timestamp;
+        ''').fetchall()
+    if not records:
+        return
+
+    ins_by_ts = {datetime.strptime(ts, TIMESTAMP_FORMAT): units for ts, units in records}
+    doses = {}
+    one_min, spread = timedelta(minutes=1), timedelta(minutes=LEGACY_INSULIN_SPREAD_MINS)
+    ts, last_ts = min(ins_by_ts), max(ins_by_ts) + one_min
+    while ts <= last_ts:
+        dose = ins_by_ts.get(ts, 0) - ins_by_ts.get(ts - one_min, 0) + doses.get(ts - spread, 0)
+        if dose > 0:
+            doses[ts] = dose
+        elif dose < 0:
+            print(f"Inconsistent legacy insulin at {ts}, ignoring {dose}u")
+        ts += one_min
+
+    insert_event_query = f"INSERT INTO {INSULIN_EVENTS_TABLE} (timestamp, units, profile) VALUES (?, ?, ?);"
+    with db.transaction():
+        db.pool.executemany(insert_event_query, [
+            (datetime.strftime(ts, TIMESTAMP_FORMAT), units, DEFAULT_INSULIN_PROFILE) for ts, units in doses.items()
+        ])
+        db.execute_query(f"UPDATE {UPDATES_DATA_TABLE} SET ins_units = 0 WHERE ins_units != 0;")
+        db.execute_query(f'''
+            DELETE FROM {UPDATES_DATA_TABLE}
+             WHERE coalesce(food_note, '') = '' AND coalesce(misc_note, '') = '';
+            ''')
+    print(f"Migrated {len(records)} legacy insulin rows into {len(doses)} events")
+
+
+class OnlineTableRebuild:
+    """
+    Rebuilds a table into a new shape while other connections keep writing to it.
+    Triggers mirror every write on the old table into the new one, existing rows are copied over in
+    short batches keyed on rowid, and `swap` replaces the old table with the new one.
+    """
+    def __init__(self, db, tablename, create_sql, column_exprs, key_column="timestamp", post_sql=()):
+        self.db = db
+        self.tablename = tablename
+        self.new_tablename = f"{tablename}_rebuild"
+        self.create_sql = create_sql
+        # new column -> expression over the old row, with {src} standing in for the row prefix
+        self.column_exprs = column_exprs
+        self.key_column = key_column
+        self.post_sql = post_sql
+
+    def _select(self, src):
+        return ", ".join(expr.format(src=src) for expr in self.column_exprs.values())
+
+    def _mirror(self, src):
+        columns = ", ".join(self.column_exprs)
+        key_expr = self.column_exprs[self.key_column].format(src=src)
+        return (f"INSERT OR REPLACE INTO {self.new_tablename} ({columns}) "
+                f"SELECT {self._select(src)} WHERE {key_expr} IS NOT NULL;")
+
+    def _remove(self, src):
+        key_expr = self.column_exprs[self.key_column].format(src=src)
+        return f"DELETE FROM {self.new_tablename} WHERE {self.key_column} = {key_expr};"
+
+    def prepare(self):
+        self.db.execute_query(self.create_sql.format(tablename=self.new_tablename))
+        triggers = {
+            "ins": f"AFTER INSERT ON {self.tablename} BEGIN {self._mirror('NEW.')} END",
+            "upd": f"AFTER UPDATE ON {self.tablename} BEGIN {self._remove('OLD.')} {self._mirror('NEW.')} END",
+            "del": f"AFTER DELETE ON {self.tablename} BEGIN {self._remove('OLD.')} END",
+        }
+        for suffix, body in triggers.items():
+            self.db.execute_query(f"CREATE TRIGGER IF NOT EXISTS {self.new_tablename}_{suffix} {body};")
+
+    def copy(self, batch_size: int):
+        columns = ", ".join(self.column_exprs)
+        key_expr = self.column_exprs[self.key_column].format(src="")
+        copy_query = f'''
+            INSERT OR IGNORE INTO {self.new_tablename} ({columns})
+            SELECT {self._select("")} FROM {self.tablename}
+             WHERE rowid > ? AND rowid <= ? AND {key_expr} IS NOT NULL;
+            '''
+        max_rowid = self.db.execute_query(f"SELECT coalesce(max(rowid), 0) FROM {self.tablename};").fetchone()[0]
+        last_rowid = 0
+        while last_rowid < max_rowid:
+            # each batch is its own short transaction, writers get the lock in between
+            with self.db.transaction():
+                self.db.execute_query(copy_query, (last_rowid, last_rowid + batch_size))
+            last_rowid += batch_size
+            print(f"{self.tablename}: copied up to rowid {min(last_rowid, max_rowid)}/{max_rowid}")
+
+    def swap(self):
+        """To be run inside a transaction."""
+        for suffix in ("ins", "upd", "del"):
+            self.db.execute_query(f"DROP TRIGGER IF EXISTS {self.new_tablename}_{suffix};")
+        self.db.execute_query(f"DROP TABLE {self.tablename};")
+        self.db.execute_query(f"ALTER TABLE {self.new_tablename} RENAME TO {self.tablename};")
+        for sql in self.post_sql:
+            self.db.execute_query(sql.format(tablename=self.tablename))
+
+
+def migrate_v2_epoch_minutes(db, batch_size: int):
+    """
+    Timestamps go from 'YYYY-mm-dd HH:MM' text to integer epoch minutes.
+    igloo_data becomes a WITHOUT ROWID table keyed on the minute. igloo_updates_data keys on it as an
+    INTEGER PRIMARY KEY instead, which clusters it the same way while keeping rowid (== timestamp)
+    available for UpdatesRowIdentifier.
+    """
+    ts_expr = TEXT_TS_TO_MINUTES
+    rebuilds = [
+        OnlineTableRebuild(
+            db, IDATA_TABLE_NAME,
+            create_sql='''
+                CREATE TABLE IF NOT EXISTS {tablename} (
+                    timestamp INTEGER PRIMARY KEY,
+                    reading_now INT,
+                    reading_20 REAL,
+                    velocity REAL
+                ) WITHOUT ROWID;
+                ''',
+            column_exprs={
+                "timestamp": ts_expr,
+                "reading_now": "{src}reading_now",
+                "reading_20": "{src}reading_20",
+                "velocity": "{src}velocity",
+            },
+        ),
+        OnlineTableRebuild(
+            db, UPDATES_DATA_TABLE,
+            create_sql='''
+                CREATE TABLE IF NOT EXISTS {tablename} (
+                    timestamp INTEGER PRIMARY KEY,
+                    ins_units INT DEFAULT 0,
+                    food_note TEXT,
+                    misc_note TEXT
+                );
+                ''',
+            column_exprs={
+                "timestamp": ts_expr,
+                "ins_units": "{src}ins_units",
+                "food_note": "{src}food_note",
+                "misc_note": "{src}misc_note",
+            },
+        ),
+        OnlineTableRebuild(
+            db, INSULIN_EVENTS_TABLE,
+            create_sql=f'''
+                CREATE TABLE IF NOT EXISTS {{tablename}} (
+                    timestamp INTEGER NOT NULL,
+                    units REAL NOT NULL,
+                    profile TEXT NOT NULL DEFAULT '{DEFAULT_INSULIN_PROFILE}'
+                );
+                ''',
+            column_exprs={
+                "rowid": "{src}rowid",
+                "timestamp": ts_expr,
+                "units": "{src}units",
+                "profile": "{src}profile",
+            },
+            key_column="rowid",
+            post_sql=("CREATE INDEX IF NOT EXISTS {tablename}_ts ON {tablename} (timestamp);",),
+        ),
+    ]
+    # a previous run may have been interrupted, only rebuild what still has text timestamps
+    rebuilds = [rb for rb in rebuilds if _column_type(db, rb.tablename, "timestamp") == "TEXT"]
+
+    for rebuild in rebuilds:
+        rebuild.prepare()
+    for rebuild in rebuilds:
+        rebuild.copy(batch_size=batch_size)
+    with db.transaction():
+        for rebuild in rebuilds:
+            rebuild.swap()
+
+
+def create_updates_fts(db):
+    """
+    External content FTS5 table over the notes, it stores only the index and reads the text from the updates table.
+    Triggers keep it in sync, shared with UpdatesTable so a new database gets the same index.
+    """
+    fts, src = UPDATES_FTS_TABLE, UPDATES_DATA_TABLE
+    db.execute_query(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            food_note,
+            misc_note,
+            content='{src}',
+            content_rowid='timestamp',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        );
+        ''')
+    insert_row = f"INSERT INTO {fts} (rowid, food_note, misc_note) VALUES (NEW.timestamp, NEW.food_note, NEW.misc_note);"
+    delete_row = (f"INSERT INTO {fts} ({fts}, rowid, food_note, misc_note) "
+                  f"VALUES ('delete', OLD.timestamp, OLD.food_note, OLD.misc_note);")
+    triggers = {
+        "ai": f"AFTER INSERT ON {src} BEGIN {insert_row} END",
+        "ad": f"AFTER DELETE ON {src} BEGIN {delete_row} END",
+        "au": f"AFTER UPDATE OF timestamp, food_note, misc_note ON {src} BEGIN {delete_row} {insert_row} END",
+    }
+    for suffix, body in triggers.items():
+        db.execute_query(f"CREATE TRIGGER IF NOT EXISTS {fts}_{suffix} {body};")
+
+
+def migrate_v3_notes_fts(db, batch_size: int):
+    """Full text index over food and misc notes, built from the existing rows."""
+    if not _table_exists(db, UPDATES_DATA_TABLE):
+        return
+    with db.transaction():
+        create_updates_fts(db)
+        db.execute_query(f"INSERT INTO {UPDATES_FTS_TABLE} ({UPDATES_FTS_TABLE}) VALUES ('rebuild');")
+
+
+def migrate_v4_rollups(db, batch_size: int):
+    """5 min, hourly and daily rollups of the readings, built from the existing rows."""
+    if not _table_exists(db, IDATA_TABLE_NAME):
+        return
+    with db.transaction():
+        create_rollups_table(db)
+        rebuild_rollups(db)
+
+
+MIGRATIONS = {
+    1: migrate_v1_insulin_events,
+    2: migrate_v2_epoch_minutes,
+    3: migrate_v3_notes_fts,
+    4: migrate_v4_rollups,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+class MigrationRunner:
+    def __init__(self, db, batch_size=DS_MIGRATION_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+
+    @property
+    def current_version(self) -> int:
+        return self.db.execute_query("PRAGMA user_version;").fetchone()[0]
+
+    def _set_version(self, version: int):
+        self.db.execute_query(f"PRAGMA user_version = {version};")
+
+    @contextmanager
+    def _exclusive(self):
+        # all three automatons open the database on start, only one of them gets to migrate it
+        with open(f"{self.db.db_path}.migrate.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run(self) -> int:
+        if self.current_version >= SCHEMA_VERSION:
+            return self.current_version
+
+        with self._exclusive():
+            version = self.current_version
+            if version == 0 and not _table_exists(self.db, IDATA_TABLE_NAME):
+                # new database, tables get created in their latest shape
+                self._set_version(SCHEMA_VERSION)
+                return SCHEMA_VERSION
+
+            for target_version in range(version + 1, SCHEMA_VERSION + 1):
+                print(f"Migrating {self.db.db_path} to schema version {target_version}")
+                MIGRATIONS[target_version](self.db, batch_size=self.batch_size)
+                self._set_version(target_version)
+            return SCHEMA_VERSION
@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config.utils import DS_PRAGMAS, DS_CACHED_STATEMENTS
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Keeps one long-lived sqlite3 connection per thread for a database file.
+    Every pooled connection gets DS_PRAGMAS applied when it is opened, and sqlite3's
+    statement cache keeps prepared statements around for parameterized queries.
+    """
+    def __init__(self, db_path, pragmas=None, cached_statements=DS_CACHED_STATEMENTS):
+        self.db_path = db_path
+        self.pragmas = dict(DS_PRAGMAS if pragmas is None else pragmas)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None keeps the connection in autocommit mode, so a statement
+        # outside of `transaction()` commits on its own, same as the old connect-per-query.
+        conn = sqlite3.connect(
+            self.db_path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    def execute(self, sql_query, params=()) -> sqlite3.Cursor:
+        return self.connection.execute(sql_query, params)
+
+    def executemany(self, sql_query, seq_of_params) -> sqlite3.Cursor:
+        return self.connection.executemany(sql_query, seq_of_params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every statement issued by this thread into one commit.
+        Nested calls join the outermost transaction.
+        """
+        conn = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE;")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        else:
+            conn.execute("COMMIT;")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    with _POOLS_LOCK:
+        pool = _POOLS.get(db_path)
+        if pool is None:
+            pool = ConnectionPool(db_path)
+            _POOLS[db_path] = pool
+        return pool
@@ -1,11 +1,22 @@
 import os.path
+import re
 import sqlite3
 from abc import abstractmethod, ABC
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Union, List
+from functools import lru_cache
+from typing import Union, List, Optional, Iterator, Tuple
 
-from config.utils import DS_FILE_NAME, DS_DATA_DIR, IDATA_TABLE_NAME, TIMESTAMP_FORMAT, UPDATES_DATA_TABLE
+import numpy as np
+
+from config.utils import DS_FILE_NAME, DS_DATA_DIR, IDATA_TABLE_NAME, TIMESTAMP_FORMAT, UPDATES_DATA_TABLE, \
+    INSULIN_EVENTS_TABLE, DEFAULT_INSULIN_PROFILE, UPDATES_FTS_TABLE, MEAL_RESPONSES_TABLE, ROLLUPS_TABLE, \
+    to_epoch_minutes, from_epoch_minutes
+from datastore.columnar import ReadingColumns, UpdatesColumns, TimelineColumns, RollupColumns, \
+    RANGE_COUNT_NAMES
+from datastore.migrations import MigrationRunner, create_updates_fts
+from datastore.pool import get_pool
+from datastore.rollups import create_rollups_table, rebuild_rollups, rollup_rows, ROLLUP_COLUMNS, ALL_TIME
 
 
 class ElementNotFoundException(Exception):
@@ -25,6 +36,10 @@ class IglooUpdatesElement:
     def timestamp_str(self) -> str:
         return datetime.strftime(self.timestamp, TIMESTAMP_FORMAT)
 
+    @property
+    def timestamp_min(self) -> int:
+        return to_epoch_minutes(self.timestamp)
+
     def __post_init__(self):
         if isinstance(self.timestamp, str):
             self.timestamp = parse_timestamp(self.timestamp)
@@ -35,7 +50,7 @@ class IglooUpdatesElement:
     def from_db_record(cls, record):
         ins_value = 0 if isinstance(record[1], str) or not record[1] else record[1]
         return cls(
-            timestamp=parse_timestamp(record[0]),
+            timestamp=from_epoch_minutes(record[0]),
             ins_units=ins_value,
             food_note=record[2] or "",
             misc_note=record[3] or "",
@@ -53,6 +68,10 @@ class IglooDataElement:
     def timestamp_str(self) -> str:
         return datetime.strftime(self.timestamp, TIMESTAMP_FORMAT)
 
+    @property
+    def timestamp_min(self) -> int:
+        return to_epoch_minutes(self.timestamp)
+
     def __post_init__(self):
         if isinstance(self.timestamp, str):
             self.timestamp = parse_timestamp(self.timestamp)
@@ -62,7 +81,7 @@ class IglooDataElement:
     @classmethod
     def from_db_record(cls, record):
         return cls(
-            timestamp=parse_timestamp(record[0]),
+            timestamp=from_epoch_minutes(record[0]),
             reading_now=record[1],
             reading_20=record[2],
             velocity=record[3],
@@ -71,32 +90,160 @@ class IglooDataElement:
     def __str__(self):
         return f"({self.timestamp_str}, {self.reading_now}, {self.reading_20}, {self.velocity})"
 
+@dataclass
+class IglooInsulinEvent:
+    timestamp: Union[datetime, str]
+    units: float = field(default=0)
+    profile: str = field(default=DEFAULT_INSULIN_PROFILE)
+    ins_rowid: int = field(default=0)
+
+    @property
+    def timestamp_str(self) -> str:
+        return datetime.strftime(self.timestamp, TIMESTAMP_FORMAT)
+
+    @property
+    def timestamp_min(self) -> int:
+        return to_epoch_minutes(self.timestamp)
+
+    def __post_init__(self):
+        if isinstance(self.timestamp, str):
+            self.timestamp = parse_timestamp(self.timestamp)
+        elif isinstance(self.timestamp, datetime):
+            self.timestamp = self.timestamp.replace(second=0, microsecond=0)
+
+    @classmethod
+    def from_db_record(cls, record):
+        return cls(
+            timestamp=from_epoch_minutes(record[0]),
+            units=record[1],
+            profile=record[2] or DEFAULT_INSULIN_PROFILE,
+            ins_rowid=record[3]
+        )
+
+@dataclass
+class IglooMealResponse:
+    timestamp: Union[datetime, str]
+    food_note: str = field(default="")
+    baseline: Optional[float] = field(default=None)
+    peak: Optional[int] = field(default=None)
+    time_to_peak: Optional[int] = field(default=None)  # mins after the meal
+    auc: float = field(default=0.0)  # mg/dL * mins above baseline
+    ins_on_board: float = field(default=0.0)  # at the time of the meal
+    ins_dosed: float = field(default=0.0)  # during the response window
+    complete: bool = field(default=False)  # the whole response window has readings up to its end
+
+    @property
+    def timestamp_str(self) -> str:
+        return datetime.strftime(self.timestamp, TIMESTAMP_FORMAT)
+
+    @property
+    def timestamp_min(self) -> int:
+        return to_epoch_minutes(self.timestamp)
+
+    @property
+    def rise(self) -> Optional[float]:
+        return self.peak - self.baseline if self.peak is not None and self.baseline is not None else None
+
+    def __post_init__(self):
+        if isinstance(self.timestamp, str):
+            self.timestamp = parse_timestamp(self.timestamp)
+        elif isinstance(self.timestamp, datetime):
+            self.timestamp = self.timestamp.replace(second=0, microsecond=0)
+
+    @classmethod
+    def from_db_record(cls, record):
+        ts, food_note, baseline, peak, time_to_peak, auc, ins_on_board, ins_dosed, complete = record
+        return cls(
+            timestamp=from_epoch_minutes(ts), food_note=food_note, baseline=baseline, peak=peak,
+            time_to_peak=time_to_peak, auc=auc, ins_on_board=ins_on_board, ins_dosed=ins_dosed, complete=bool(complete)
+        )
+
+def encode_timestamp(ts: Union[str, datetime, int]) -> int:
+    """Anything callers pass as a timestamp, as the epoch minutes stored in the tables."""
+    if isinstance(ts, datetime):
+        return to_epoch_minutes(ts)
+    if isinstance(ts, str):
+        return to_epoch_minutes(parse_timestamp(ts))
+    return int(ts)
+
 def parse_timestamp(ts_str: str) -> datetime:
     try:
         return datetime.strptime(ts_str[:16], TIMESTAMP_FORMAT)
     except ValueError:
         raise ValueError(f"Invalid timestamp format: {ts_str}. Expected format: {TIMESTAMP_FORMAT}.")
 
+# upper bound for open ended searches, far beyond any real epoch minute
+SEARCH_MAX_TIMESTAMP = 1 << 62
+
+
 class SqliteDatabase:
     def __init__(self, data_dir=DS_DATA_DIR, db_filename=DS_FILE_NAME):
         self.db_path = os.path.join(data_dir, db_filename)
+        # connections (and their PRAGMAs) are shared by every SqliteDatabase on the same file
+        self.pool = get_pool(self.db_path)
+        MigrationRunner(self).run()
 
-        self._set_database_good_habits()
         self.main_table = MainTable(self)
         self.updates_table = UpdatesTable(self)
+        self.insulin_table = InsulinTable(self)
+        self.meal_responses_table = MealResponseTable(self)
+        self.rollups_table = RollupsTable(self)
 
     def execute_query(self, sql_query, params=()):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql_query, params)
-        return cursor
-
-    def _set_database_good_habits(self):
-        # Enable Write-Ahead Logging for better read/write concurrency
-        self.execute_query("PRAGMA journal_mode=WAL;")
-        # Set a busy timeout (in milliseconds).
-        # If the DB is locked, SQLite will retry for up to this many ms.
-        self.execute_query("PRAGMA busy_timeout = 6000;")
+        return self.pool.execute(sql_query, params)
+
+    def transaction(self):
+        return self.pool.transaction()
+
+    def _timeline_cursor(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime], descending: bool):
+        # both tables are keyed on timestamp, so this is two index range scans merged in sqlite
+        timeline_query = f'''
+        SELECT
+            d.timestamp,
+            coalesce(d.reading_now, 0),
+            coalesce(d.reading_20, 0),
+            coalesce(d.velocity, 0),
+            coalesce(u.food_note, ''),
+            coalesce(u.misc_note, ''),
+            coalesce(u.rowid, 0)
+        FROM
+            {IDATA_TABLE_NAME} d LEFT JOIN {UPDATES_DATA_TABLE} u ON u.timestamp = d.timestamp
+        WHERE
+            d.timestamp BETWEEN :ts_start AND :ts_end
+        UNION ALL
+        SELECT
+            u.timestamp, 0, 0, 0, coalesce(u.food_note, ''), coalesce(u.misc_note, ''), u.rowid
+        FROM
+            {UPDATES_DATA_TABLE} u
+        WHERE
+            u.timestamp BETWEEN :ts_start AND :ts_end
+            AND NOT EXISTS (SELECT 1 FROM {IDATA_TABLE_NAME} d WHERE d.timestamp = u.timestamp)
+        ORDER BY
+            1 {"DESC" if descending else "ASC"}
+        ;
+        '''
+        return self.execute_query(timeline_query, {
+            "ts_start": encode_timestamp(ts_start), "ts_end": encode_timestamp(ts_end)
+        })
+
+    def iter_timeline(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime],
+                      descending: bool = True) -> Iterator[Tuple]:
+        """
+        Readings and notes of the window merged on timestamp, as (timestamp, reading_now, reading_20, velocity,
+        food_note, misc_note, upd_rowid) rows with datetime timestamps, streamed off the cursor in order.
+        """
+        for record in self._timeline_cursor(ts_start, ts_end, descending):
+            yield (from_epoch_minutes(record[0]),) + tuple(record[1:])
+
+    def fetch_timeline_columns(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> TimelineColumns:
+        """Same rows as iter_timeline, as numpy columns in ascending order."""
+        return TimelineColumns.from_records(self._timeline_cursor(ts_start, ts_end, descending=False).fetchall())
+
+
+@lru_cache(maxsize=None)
+def get_database(data_dir=DS_DATA_DIR, db_filename=DS_FILE_NAME) -> SqliteDatabase:
+    """Process wide SqliteDatabase, so tables are only set up once per process."""
+    return SqliteDatabase(data_dir=data_dir, db_filename=db_filename)
 
 class BaseTable(ABC):
     def __init__(self, db: SqliteDatabase):
@@ -109,39 +256,27 @@ class BaseTable(ABC):
     def execute(self, query, params=()):
         return self.db.execute_query(query, params)
 
+    def executemany(self, query, seq_of_params):
+        with self.db.transaction():
+            return self.db.pool.executemany(query, seq_of_params)
+
 class MainTable(BaseTable):
     def __init__(self, db: SqliteDatabase):
         super().__init__(db)
         self.tablename = IDATA_TABLE_NAME
         self._create()
-        # self._col_updates()
 
     def _create(self):
         create_table_query = f'''
                CREATE TABLE IF NOT EXISTS {self.tablename} (
-                   timestamp TEXT PRIMARY KEY,
+                   timestamp INTEGER PRIMARY KEY,
                    reading_now INT,
                    reading_20 REAL,
                    velocity REAL
-               );
+               ) WITHOUT ROWID;
                '''
         self.execute(create_table_query)
 
-    def _col_updates(self):
-        """
-        Fixes existing values in the dataset, to be executed only once
-        :return:
-        """
-        update_query = f"UPDATE {self.tablename} SET timestamp = substr(timestamp, 1, 16);"
-        self.execute(update_query)
-
-        for col_to_drop in ["notes", "food", "insulin_units"]:
-            try:
-                update_query = f"ALTER TABLE {self.tablename} DROP COLUMN {col_to_drop};"
-                self.execute(update_query)
-            except sqlite3.OperationalError:
-                pass
-
     def insert_element(self, new_element: IglooDataElement):
         insert_element_query = f'''
             INSERT INTO {self.tablename} (
@@ -149,18 +284,17 @@ class MainTable(BaseTable):
                 reading_now,
                 reading_20,
                 velocity
-            ) VALUES (
-                '{new_element.timestamp_str}',
-                '{new_element.reading_now}', 
-                '{new_element.reading_20}', 
-                '{new_element.velocity}'
-            );
+            ) VALUES (?, ?, ?, ?);
             '''
         print(f"Trying to insert {new_element} into {self.tablename}")
-        self.execute(insert_element_query)
-
-    def update_reading_and_velocity(self, timestamp: str, reading_20: float, velocity: float):
-        timestamp = datetime.strftime(timestamp, TIMESTAMP_FORMAT) if isinstance(timestamp, datetime) else timestamp
+        self.execute(insert_element_query, (
+            new_element.timestamp_min,
+            new_element.reading_now,
+            new_element.reading_20,
+            new_element.velocity
+        ))
+
+    def update_reading_and_velocity(self, timestamp: Union[str, datetime], reading_20: float, velocity: float):
         print(f"Updating reading_20:{reading_20}, velocity:{velocity} for timestamp {timestamp}")
         update_element_query = f"""
         UPDATE {self.tablename}
@@ -168,7 +302,7 @@ class MainTable(BaseTable):
                velocity = ?
          WHERE timestamp = ?;
         """
-        self.execute(update_element_query, (reading_20, velocity, timestamp))
+        self.execute(update_element_query, (reading_20, velocity, encode_timestamp(timestamp)))
 
     def update_computed_vals(self, new_element: IglooDataElement):
         print(f"Trying to update {new_element} into {self.tablename}")
@@ -178,20 +312,54 @@ class MainTable(BaseTable):
                    velocity = ?
              WHERE timestamp = ?;
             '''
-        self.execute(update_element_query, (new_element.reading_20, new_element.velocity, new_element.timestamp_str))
+        self.execute(update_element_query, (new_element.reading_20, new_element.velocity, new_element.timestamp_min))
+
+    @staticmethod
+    def _as_params(elements: List[IglooDataElement]):
+        return [(el.timestamp_min, el.reading_now, el.reading_20, el.velocity) for el in elements]
+
+    def insert_many(self, new_elements: List[IglooDataElement]) -> int:
+        """Inserts all elements in one transaction, rows already present are left untouched."""
+        insert_many_query = f'''
+            INSERT INTO {self.tablename} (
+                timestamp,
+                reading_now,
+                reading_20,
+                velocity
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT(timestamp) DO NOTHING;
+            '''
+        print(f"Trying to insert {len(new_elements)} elements into {self.tablename}")
+        return self.executemany(insert_many_query, self._as_params(new_elements)).rowcount
+
+    def upsert_many(self, elements: List[IglooDataElement]) -> int:
+        """Inserts or overwrites all elements in one transaction."""
+        upsert_many_query = f'''
+            INSERT INTO {self.tablename} (
+                timestamp,
+                reading_now,
+                reading_20,
+                velocity
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT(timestamp) DO UPDATE
+               SET reading_now = excluded.reading_now,
+                   reading_20 = excluded.reading_20,
+                   velocity = excluded.velocity;
+            '''
+        print(f"Trying to upsert {len(elements)} elements into {self.tablename}")
+        return self.executemany(upsert_many_query, self._as_params(elements)).rowcount
 
     def fetch_w_ts(self, timestamp: Union[str, datetime]) -> IglooDataElement:
-        timestamp = datetime.strftime(timestamp, TIMESTAMP_FORMAT) if isinstance(timestamp, datetime) else timestamp
         fetch_record_query = f'''
         SELECT 
             * 
         FROM 
             {self.tablename} 
         WHERE 
-            timestamp = '{timestamp}'
+            timestamp = ?
         ;
         '''
-        cursor = self.execute(fetch_record_query)
+        cursor = self.execute(fetch_record_query, (encode_timestamp(timestamp),))
         record = cursor.fetchone()
         if not record:
             raise ElementNotFoundException(f"{timestamp} : Not found")
@@ -199,8 +367,6 @@ class MainTable(BaseTable):
         return IglooDataElement.from_db_record(record=record)
 
     def fetch_w_ts_range(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> List[IglooDataElement]:
-        ts_start = str(ts_start) if isinstance(ts_start, datetime) else ts_start
-        ts_end = str(ts_end) if isinstance(ts_end, datetime) else ts_end
         # print(f"querying {self.tablename} for records between {ts_start} and {ts_end}")
         fetch_range_query = f'''
         SELECT 
@@ -208,16 +374,67 @@ class MainTable(BaseTable):
         FROM 
             {self.tablename} 
         WHERE 
-            timestamp BETWEEN '{ts_start}' AND '{ts_end}'
+            timestamp BETWEEN ? AND ?
         ORDER BY
             timestamp DESC
         ;
         '''
-        cursor = self.execute(fetch_range_query)
+        cursor = self.execute(fetch_range_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
         records = cursor.fetchall()
         idel_list = [IglooDataElement.from_db_record(rec) for rec in records]
         return idel_list
 
+    def update_computed_columns(self, timestamp_min: np.ndarray, reading_20: np.ndarray, velocity: np.ndarray) -> int:
+        """update_computed_vals for whole arrays, in one transaction."""
+        update_many_query = f"UPDATE {self.tablename} SET reading_20 = ?, velocity = ? WHERE timestamp = ?;"
+        params = zip(reading_20.tolist(), velocity.tolist(), timestamp_min.tolist())
+        return self.executemany(update_many_query, params).rowcount
+
+    def fetch_earliest_timestamp(self) -> Optional[datetime]:
+        earliest = self.execute(f"SELECT min(timestamp) FROM {self.tablename};").fetchone()[0]
+        return from_epoch_minutes(earliest) if earliest is not None else None
+
+    def fetch_latest_timestamp(self) -> Optional[datetime]:
+        latest = self.execute(f"SELECT max(timestamp) FROM {self.tablename};").fetchone()[0]
+        return from_epoch_minutes(latest) if latest is not None else None
+
+    def fetch_columns(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> ReadingColumns:
+        """Same rows as fetch_w_ts_range, as numpy columns in ascending order, without building elements."""
+        fetch_columns_query = f'''
+        SELECT 
+            timestamp,
+            coalesce(reading_now, 0),
+            coalesce(reading_20, 0),
+            coalesce(velocity, 0)
+        FROM 
+            {self.tablename} 
+        WHERE 
+            timestamp BETWEEN ? AND ?
+        ORDER BY
+            timestamp ASC
+        ;
+        '''
+        cursor = self.execute(fetch_columns_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return ReadingColumns.from_records(cursor.fetchall())
+
+    def fetch_version(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> Tuple:
+        """Changes whenever a reading of the window is added, changed or removed, without reading the rows out."""
+        fetch_version_query = f'''
+        SELECT
+            count(*),
+            max(timestamp),
+            total(reading_now),
+            total(reading_20),
+            total(velocity)
+        FROM
+            {self.tablename}
+        WHERE
+            timestamp BETWEEN ? AND ?
+        ;
+        '''
+        cursor = self.execute(fetch_version_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return tuple(cursor.fetchone())
+
 class UpdatesTable(BaseTable):
     def __init__(self, db: SqliteDatabase):
         super().__init__(db)
@@ -227,13 +444,14 @@ class UpdatesTable(BaseTable):
     def _create(self):
         create_live_table_query = f'''
                 CREATE TABLE IF NOT EXISTS {self.tablename} (
-                    timestamp TEXT PRIMARY KEY,
+                    timestamp INTEGER PRIMARY KEY,
                     ins_units INT DEFAULT 0,
                     food_note TEXT,
                     misc_note TEXT
                 );
                 '''
         self.execute(query=create_live_table_query)
+        create_updates_fts(self.db)
 
     def insert(self, new_element: IglooUpdatesElement):
         try:
@@ -243,15 +461,15 @@ class UpdatesTable(BaseTable):
                             ins_units,
                             food_note,
                             misc_note
-                        ) VALUES (
-                            '{new_element.timestamp_str}',
-                            '{new_element.ins_units}',
-                            '{new_element.food_note}',
-                            '{new_element.misc_note}' 
-                        );
+                        ) VALUES (?, ?, ?, ?);
                         '''
             print(f"Inserting {new_element} into {self.tablename}")
-            self.execute(query=insert_element_query)
+            self.execute(query=insert_element_query, params=(
+                new_element.timestamp_min,
+                new_element.ins_units,
+                new_element.food_note,
+                new_element.misc_note
+            ))
         except sqlite3.IntegrityError:
             print("Received Integrity error. Passing")
 
@@ -259,7 +477,7 @@ class UpdatesTable(BaseTable):
     def insert_or_replace_row(self, element: IglooUpdatesElement):
         try:
             sql = f'INSERT INTO {self.tablename} (timestamp) VALUES (?)'
-            self.execute(query=sql, params=(element.timestamp_str,))
+            self.execute(query=sql, params=(element.timestamp_min,))
         except Exception as es:
             pass
 
@@ -288,13 +506,50 @@ class UpdatesTable(BaseTable):
         if columns_to_update:
             print(f"Trying to update {element} into {self.tablename}")
             sql = f"UPDATE {self.tablename} SET {', '.join(columns_to_update)} WHERE timestamp = ?"
-            values.append(element.timestamp_str)
+            values.append(element.timestamp_min)
             self.execute(query=sql, params=tuple(values))
             print("update done.")
 
+    @staticmethod
+    def _as_params(elements: List[IglooUpdatesElement]):
+        return [(el.timestamp_min, el.ins_units, el.food_note, el.misc_note) for el in elements]
+
+    def insert_many(self, new_elements: List[IglooUpdatesElement]) -> int:
+        """Inserts all elements in one transaction, rows already present are left untouched."""
+        insert_many_query = f'''
+            INSERT INTO {self.tablename} (
+                timestamp,
+                ins_units,
+                food_note,
+                misc_note
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT(timestamp) DO NOTHING;
+            '''
+        print(f"Inserting {len(new_elements)} elements into {self.tablename}")
+        return self.executemany(insert_many_query, self._as_params(new_elements)).rowcount
+
+    def upsert_many(self, elements: List[IglooUpdatesElement]) -> int:
+        """Same merge rules as update_, non-default values win and notes are appended, in one transaction."""
+        upsert_many_query = f'''
+            INSERT INTO {self.tablename} (
+                timestamp,
+                ins_units,
+                food_note,
+                misc_note
+            ) VALUES (?, ?, ?, ?)
+            ON CONFLICT(timestamp) DO UPDATE
+               SET ins_units = CASE WHEN excluded.ins_units != 0 THEN excluded.ins_units ELSE ins_units END,
+                   food_note = CASE WHEN excluded.food_note != ''
+                                    THEN trim(coalesce(food_note, '') || ',' || excluded.food_note, ',')
+                                    ELSE food_note END,
+                   misc_note = CASE WHEN excluded.misc_note != ''
+                                    THEN trim(coalesce(misc_note, '') || ',' || excluded.misc_note, ',')
+                                    ELSE misc_note END;
+            '''
+        print(f"Trying to upsert {len(elements)} elements into {self.tablename}")
+        return self.executemany(upsert_many_query, self._as_params(elements)).rowcount
+
     def fetch_w_ts_range(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> List[IglooUpdatesElement]:
-        ts_start = str(ts_start) if isinstance(ts_start, datetime) else ts_start
-        ts_end = str(ts_end) if isinstance(ts_end, datetime) else ts_end
         fetch_range_query = f'''
         SELECT 
             *,
@@ -302,18 +557,52 @@ class UpdatesTable(BaseTable):
         FROM 
             {self.tablename} 
         WHERE 
-            timestamp BETWEEN '{ts_start}' AND '{ts_end}'
+            timestamp BETWEEN ? AND ?
         ORDER BY
             timestamp DESC
         ;
         '''
-        cursor = self.execute(fetch_range_query)
+        cursor = self.execute(fetch_range_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
         records = cursor.fetchall()
         idul_list = [IglooUpdatesElement.from_db_record(rec) for rec in records]
         return idul_list
 
+    def fetch_columns(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> UpdatesColumns:
+        """Same rows as fetch_w_ts_range, as numpy columns in ascending order, without building elements."""
+        fetch_columns_query = f'''
+        SELECT 
+            timestamp,
+            coalesce(food_note, ''),
+            coalesce(misc_note, ''),
+            rowid 
+        FROM 
+            {self.tablename} 
+        WHERE 
+            timestamp BETWEEN ? AND ?
+        ORDER BY
+            timestamp ASC
+        ;
+        '''
+        cursor = self.execute(fetch_columns_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return UpdatesColumns.from_records(cursor.fetchall())
+
+    def fetch_version(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> Tuple:
+        # notes are few and short, so they are compared as they are
+        fetch_version_query = f'''
+        SELECT
+            count(*),
+            total(ins_units),
+            group_concat(timestamp || ':' || coalesce(food_note, '') || ':' || coalesce(misc_note, ''), char(31))
+        FROM
+            {self.tablename}
+        WHERE
+            timestamp BETWEEN ? AND ?
+        ;
+        '''
+        cursor = self.execute(fetch_version_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return tuple(cursor.fetchone())
+
     def fetch_w_ts(self, timestamp: Union[str, datetime]) -> IglooUpdatesElement:
-        timestamp = datetime.strftime(timestamp, TIMESTAMP_FORMAT) if isinstance(timestamp, datetime) else timestamp
         fetch_record_query = f'''
         SELECT 
             *,
@@ -321,10 +610,10 @@ class UpdatesTable(BaseTable):
         FROM 
             {self.tablename} 
         WHERE 
-            timestamp = '{timestamp}'
+            timestamp = ?
         ;
         '''
-        cursor = self.execute(fetch_record_query)
+        cursor = self.execute(fetch_record_query, (encode_timestamp(timestamp),))
         record = cursor.fetchone()
         if not record:
             raise ElementNotFoundException(f"{timestamp} : Not found")
@@ -339,16 +628,265 @@ class UpdatesTable(BaseTable):
         FROM 
             {self.tablename} 
         WHERE 
-            rowid = '{rowid}'
+            rowid = ?
         ;
         '''
-        cursor = self.execute(fetch_record_query)
+        cursor = self.execute(fetch_record_query, (rowid,))
         record = cursor.fetchone()
         if not record:
             raise ElementNotFoundException(f"{rowid} : Not found")
 
         return IglooUpdatesElement.from_db_record(record=record)
 
+    def search(self, match_query: str, ts_start: Union[str, datetime, None] = None,
+               ts_end: Union[str, datetime, None] = None, by_rank: bool = True, limit: int = 50) -> List[Tuple]:
+        """
+        (rowid, food_note, misc_note) of the rows whose notes match the FTS5 `match_query`,
+        best match first or newest first, optionally limited to [ts_start, ts_end].
+        """
+        search_query = f'''
+        SELECT 
+            rowid,
+            coalesce(food_note, ''),
+            coalesce(misc_note, '')
+        FROM 
+            {UPDATES_FTS_TABLE} 
+        WHERE 
+            {UPDATES_FTS_TABLE} MATCH ?
+            AND rowid BETWEEN ? AND ?
+        ORDER BY
+            {"rank" if by_rank else "rowid DESC"}
+        LIMIT ?
+        ;
+        '''
+        ts_start = encode_timestamp(ts_start) if ts_start is not None else 0
+        ts_end = encode_timestamp(ts_end) if ts_end is not None else SEARCH_MAX_TIMESTAMP
+        return self.execute(search_query, (match_query, ts_start, ts_end, limit)).fetchall()
+
+
+def fts_match_query(text: str, column: Optional[str] = None, prefix: bool = True) -> Optional[str]:
+    """
+    Free text into an FTS5 query matching rows that contain every word, quoted so user input can not break the syntax.
+    With `prefix`, 'bre' matches 'bread'. None when the text has no words at all.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    terms = " ".join(f'"{word}"{"*" if prefix else ""}' for word in words)
+    return f"{column} : ({terms})" if column else terms
+
+
+class InsulinTable(BaseTable):
+    """One row per insulin dose; insulin-on-board is computed from these at read time."""
+    def __init__(self, db: SqliteDatabase):
+        super().__init__(db)
+        self.tablename = INSULIN_EVENTS_TABLE
+        self._create()
+
+    def _create(self):
+        create_table_query = f'''
+                CREATE TABLE IF NOT EXISTS {self.tablename} (
+                    timestamp INTEGER NOT NULL,
+                    units REAL NOT NULL,
+                    profile TEXT NOT NULL DEFAULT '{DEFAULT_INSULIN_PROFILE}'
+                );
+                '''
+        self.execute(query=create_table_query)
+        self.execute(query=f"CREATE INDEX IF NOT EXISTS {self.tablename}_ts ON {self.tablename} (timestamp);")
+
+    def insert(self, new_event: IglooInsulinEvent):
+        insert_event_query = f'''
+            INSERT INTO {self.tablename} (
+                timestamp,
+                units,
+                profile
+            ) VALUES (?, ?, ?);
+            '''
+        print(f"Inserting {new_event} into {self.tablename}")
+        self.execute(insert_event_query, (new_event.timestamp_min, new_event.units, new_event.profile))
+
+    def fetch_w_ts_range(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> List[IglooInsulinEvent]:
+        fetch_range_query = f'''
+        SELECT 
+            timestamp,
+            units,
+            profile,
+            rowid 
+        FROM 
+            {self.tablename} 
+        WHERE 
+            timestamp BETWEEN ? AND ?
+        ORDER BY
+            timestamp ASC
+        ;
+        '''
+        cursor = self.execute(fetch_range_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return [IglooInsulinEvent.from_db_record(rec) for rec in cursor.fetchall()]
+
+    def fetch_version(self, ts_start: Union[str, datetime], ts_end: Union[str, datetime]) -> Tuple:
+        fetch_version_query = f'''
+        SELECT
+            count(*),
+            total(units),
+            total(timestamp * units),
+            group_concat(profile)
+        FROM
+            {self.tablename}
+        WHERE
+            timestamp BETWEEN ? AND ?
+        ;
+        '''
+        cursor = self.execute(fetch_version_query, (encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return tuple(cursor.fetchone())
+
+
+class MealResponseTable(BaseTable):
+    """Derived from the readings, notes and insulin tables, one row per food note, keyed on its timestamp."""
+    def __init__(self, db: SqliteDatabase):
+        super().__init__(db)
+        self.tablename = MEAL_RESPONSES_TABLE
+        self._create()
+
+    def _create(self):
+        create_table_query = f'''
+                CREATE TABLE IF NOT EXISTS {self.tablename} (
+                    timestamp INTEGER PRIMARY KEY,
+                    food_note TEXT NOT NULL,
+                    baseline REAL,
+                    peak INT,
+                    time_to_peak INT,
+                    auc REAL NOT NULL DEFAULT 0,
+                    ins_on_board REAL NOT NULL DEFAULT 0,
+                    ins_dosed REAL NOT NULL DEFAULT 0,
+                    complete INT NOT NULL DEFAULT 0
+                );
+                '''
+        self.execute(query=create_table_query)
+
+    def upsert_many(self, responses: List[IglooMealResponse]) -> int:
+        upsert_many_query = f'''
+            INSERT OR REPLACE INTO {self.tablename} (
+                timestamp,
+                food_note,
+                baseline,
+                peak,
+                time_to_peak,
+                auc,
+                ins_on_board,
+                ins_dosed,
+                complete
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+            '''
+        return self.executemany(upsert_many_query, [
+            (r.timestamp_min, r.food_note, r.baseline, r.peak, r.time_to_peak, r.auc, r.ins_on_board, r.ins_dosed,
+             int(r.complete)) for r in responses
+        ]).rowcount
+
+    def fetch_pending_meals(self, ts_start: Union[str, datetime, None] = None, ts_end: Union[str, datetime, None] = None,
+                            limit: int = -1) -> List[Tuple[datetime, str]]:
+        """
+        Food notes in [ts_start, ts_end] (all of them by default) without a complete response, or whose note changed
+        since it was computed. Oldest first, at most `limit` of them.
+        """
+        fetch_pending_query = f'''
+        SELECT 
+            u.timestamp,
+            u.food_note
+        FROM 
+            {UPDATES_DATA_TABLE} u LEFT JOIN {self.tablename} m ON m.timestamp = u.timestamp
+        WHERE 
+            u.timestamp BETWEEN ? AND ?
+            AND coalesce(u.food_note, '') != ''
+            AND (m.timestamp IS NULL OR m.complete = 0 OR m.food_note != u.food_note)
+        ORDER BY
+            u.timestamp ASC
+        LIMIT ?
+        ;
+        '''
+        cursor = self.execute(fetch_pending_query, (
+            encode_timestamp(ts_start) if ts_start is not None else -ALL_TIME,
+            encode_timestamp(ts_end) if ts_end is not None else ALL_TIME,
+            limit,
+        ))
+        return [(from_epoch_minutes(ts), note) for ts, note in cursor.fetchall()]
+
+    def delete_orphans(self) -> int:
+        """Drops responses whose food note has since been removed."""
+        delete_query = f'''
+            DELETE FROM {self.tablename}
+             WHERE timestamp NOT IN (
+                SELECT timestamp FROM {UPDATES_DATA_TABLE} WHERE coalesce(food_note, '') != ''
+             );
+            '''
+        return self.execute(delete_query).rowcount
+
+    def fetch_matching(self, match_query: str, complete_only: bool = True) -> List[IglooMealResponse]:
+        """Responses of the meals whose food note matches the FTS5 `match_query`, oldest first."""
+        fetch_matching_query = f'''
+        SELECT 
+            m.*
+        FROM 
+            {UPDATES_FTS_TABLE} f JOIN {self.tablename} m ON m.timestamp = f.rowid
+        WHERE 
+            f.food_note MATCH ?
+            {"AND m.complete = 1" if complete_only else ""}
+        ORDER BY
+            m.timestamp ASC
+        ;
+        '''
+        cursor = self.execute(fetch_matching_query, (match_query,))
+        return [IglooMealResponse.from_db_record(rec) for rec in cursor.fetchall()]
+
+
+class RollupsTable(BaseTable):
+    """Aggregates of igloo_data at each of ROLLUP_RESOLUTIONS, added to as readings are inserted."""
+    def __init__(self, db: SqliteDatabase):
+        super().__init__(db)
+        self.tablename = ROLLUPS_TABLE
+        self._create()
+
+    def _create(self):
+        create_rollups_table(self.db)
+
+    def add_readings(self, timestamp_min: List[int], readings: List[int]) -> int:
+        """Folds newly inserted readings into their buckets, in one transaction."""
+        if not len(timestamp_min):
+            return 0
+        added = [name for name in ROLLUP_COLUMNS if name not in ("resolution", "bucket", "min", "max")]
+        add_rows_query = f'''
+            INSERT INTO {self.tablename} ({", ".join(ROLLUP_COLUMNS)})
+            VALUES ({", ".join("?" * len(ROLLUP_COLUMNS))})
+            ON CONFLICT(resolution, bucket) DO UPDATE
+               SET {", ".join(f"{name} = {name} + excluded.{name}" for name in added)},
+                   min = min(min, excluded.min),
+                   max = max(max, excluded.max);
+            '''
+        return self.executemany(add_rows_query, rollup_rows(timestamp_min, readings)).rowcount
+
+    def rebuild(self, ts_start: Union[str, datetime, None] = None, ts_end: Union[str, datetime, None] = None):
+        """Recomputes the buckets touching [ts_start, ts_end] from igloo_data, everything by default."""
+        with self.db.transaction():
+            rebuild_rollups(self.db,
+                            ts_start=encode_timestamp(ts_start) if ts_start is not None else None,
+                            ts_end=encode_timestamp(ts_end) if ts_end is not None else None)
+
+    def fetch_columns(self, resolution: int, ts_start: Union[str, datetime],
+                      ts_end: Union[str, datetime]) -> RollupColumns:
+        """Buckets of `resolution` starting in [ts_start, ts_end], in ascending order."""
+        fetch_columns_query = f'''
+        SELECT 
+            bucket, count, sum, sumsq, min, max, {", ".join(RANGE_COUNT_NAMES)}
+        FROM 
+            {self.tablename} 
+        WHERE 
+            resolution = ? AND bucket BETWEEN ? AND ?
+        ORDER BY
+            bucket ASC
+        ;
+        '''
+        cursor = self.execute(fetch_columns_query, (resolution, encode_timestamp(ts_start), encode_timestamp(ts_end)))
+        return RollupColumns.from_records(cursor.fetchall())
+
 
 if __name__ == '__main__':
     # sqldb = SqliteDatabase()
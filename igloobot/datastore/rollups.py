@@ -0,0 +1,93 @@
+"""
+Rollups of igloo_data, one row per (resolution, bucket) with the bucket being the epoch minute it starts at.
+Kept here rather than on the table class since the migration that introduces them builds them too.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config.utils import IDATA_TABLE_NAME, ROLLUPS_TABLE, ROLLUP_RESOLUTIONS, GLU_RANGE_EDGES, classify_glu_ranges
+from datastore.columnar import RANGE_COUNT_NAMES
+
+# bound for open ended rebuilds, far beyond any real epoch minute
+ALL_TIME = 1 << 62
+ROLLUP_COLUMNS = ("resolution", "bucket", "count", "sum", "sumsq", "min", "max") + RANGE_COUNT_NAMES
+
+
+def create_rollups_table(db):
+    range_columns = ",\n".join(f"    {name} INT NOT NULL DEFAULT 0" for name in RANGE_COUNT_NAMES)
+    db.execute_query(f'''
+        CREATE TABLE IF NOT EXISTS {ROLLUPS_TABLE} (
+            resolution INT NOT NULL,
+            bucket INT NOT NULL,
+            count INT NOT NULL,
+            sum INT NOT NULL,
+            sumsq INT NOT NULL,
+            min INT NOT NULL,
+            max INT NOT NULL,
+        {range_columns},
+            PRIMARY KEY (resolution, bucket)
+        ) WITHOUT ROWID;
+        ''')
+
+
+def _range_count_exprs() -> List[str]:
+    # same bins as classify_glu_ranges
+    lower_bounds = [None] + GLU_RANGE_EDGES.tolist()
+    upper_bounds = GLU_RANGE_EDGES.tolist() + [None]
+    exprs = []
+    for lower, upper in zip(lower_bounds, upper_bounds):
+        conditions = [f"reading_now >= {lower}" if lower is not None else None,
+                      f"reading_now < {upper}" if upper is not None else None]
+        exprs.append(f"sum({' AND '.join(c for c in conditions if c)})")
+    return exprs
+
+
+def rebuild_rollups(db, ts_start: Optional[int] = None, ts_end: Optional[int] = None):
+    """
+    Recomputes every bucket touching [ts_start, ts_end] (epoch minutes, the whole table by default) from igloo_data.
+    To be run inside a transaction.
+    """
+    for resolution in ROLLUP_RESOLUTIONS:
+        bucket_start = ts_start - ts_start % resolution if ts_start is not None else -ALL_TIME
+        bucket_end = ts_end - ts_end % resolution + resolution - 1 if ts_end is not None else ALL_TIME
+        db.execute_query(f"DELETE FROM {ROLLUPS_TABLE} WHERE resolution = ? AND bucket BETWEEN ? AND ?;",
+                         (resolution, bucket_start, bucket_end))
+        db.execute_query(f'''
+            INSERT INTO {ROLLUPS_TABLE} ({", ".join(ROLLUP_COLUMNS)})
+            SELECT
+                {resolution},
+                timestamp - timestamp % {resolution} AS bucket,
+                count(*),
+                sum(reading_now),
+                sum(reading_now * reading_now),
+                min(reading_now),
+                max(reading_now),
+                {", ".join(_range_count_exprs())}
+            FROM {IDATA_TABLE_NAME}
+            WHERE timestamp BETWEEN ? AND ?
+            GROUP BY bucket;
+            ''', (bucket_start, bucket_end))
+
+
+def rollup_rows(ts_min: np.ndarray, readings: np.ndarray) -> List[Tuple]:
+    """Rollup rows of a batch of readings, one per touched bucket of every resolution, to be added to the table."""
+    ts_min, readings = np.asarray(ts_min, dtype=np.int64), np.asarray(readings, dtype=np.int64)
+    range_ids = classify_glu_ranges(readings)
+    rows = []
+    for resolution in ROLLUP_RESOLUTIONS:
+        buckets, bucket_idx = np.unique(ts_min - ts_min % resolution, return_inverse=True)
+        n_buckets = len(buckets)
+        counts = np.bincount(bucket_idx, minlength=n_buckets)
+        sums = np.bincount(bucket_idx, weights=readings, minlength=n_buckets)
+        sumsqs = np.bincount(bucket_idx, weights=readings * readings, minlength=n_buckets)
+        mins = np.full(n_buckets, np.iinfo(np.int64).max)
+        maxs = np.full(n_buckets, np.iinfo(np.int64).min)
+        np.minimum.at(mins, bucket_idx, readings)
+        np.maximum.at(maxs, bucket_idx, readings)
+        range_counts = np.zeros((n_buckets, len(RANGE_COUNT_NAMES)), dtype=np.int64)
+        np.add.at(range_counts, (bucket_idx, range_ids - 1), 1)
+        for idx in range(n_buckets):
+            rows.append((resolution, int(buckets[idx]), int(counts[idx]), int(sums[idx]), int(sumsqs[idx]),
+                         int(mins[idx]), int(maxs[idx]), *range_counts[idx].tolist()))
+    return rows
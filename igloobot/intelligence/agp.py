@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Tuple
+
+import numpy as np
+
+from config.utils import time_in_range
+from datastore.columnar import ReadingColumns
+from datastore.primitives import SqliteDatabase
+from intelligence.projection import as_minutes
+
+MINS_IN_DAY = 24 * 60
+AGP_BIN_MINS = 15
+AGP_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+@dataclass
+class AgpProfile:
+    """Percentiles of the readings by time of day, pooled over every day of [start, end]."""
+    start: datetime
+    end: datetime
+    bin_mins: int = AGP_BIN_MINS
+    # minute of day each bin starts at
+    bin_starts: np.ndarray = field(default_factory=lambda: np.array([], dtype=np.int64))
+    # one row per AGP_PERCENTILES entry, one column per bin, nan for bins without readings
+    bands: np.ndarray = field(default_factory=lambda: np.empty((len(AGP_PERCENTILES), 0)))
+    n_readings: int = 0
+    # (below, in range, above) percentages over the whole period
+    time_in_range: Tuple[float, float, float] = (0.0, 0.0, 0.0)
+
+    def band(self, percentile: int) -> np.ndarray:
+        return self.bands[AGP_PERCENTILES.index(percentile)]
+
+
+def binned_percentiles(bins: np.ndarray, values: np.ndarray, n_bins: int, percentiles=AGP_PERCENTILES) -> np.ndarray:
+    """
+    np.percentile (linear interpolation) of the values of every bin at once: one sort by (bin, value),
+    after which each bin is a contiguous run and every percentile is an index into it.
+    """
+    order = np.lexsort((values, bins))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(bins, minlength=n_bins)
+    run_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has_values = counts > 0
+
+    bands = np.full((len(percentiles), n_bins), np.nan)
+    for row, percentile in enumerate(percentiles):
+        position = (counts[has_values] - 1) * percentile / 100
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts[has_values] - 1)
+        starts = run_starts[has_values]
+        low_vals, high_vals = sorted_values[starts + lower], sorted_values[starts + upper]
+        bands[row, has_values] = low_vals + (high_vals - low_vals) * (position - lower)
+    return bands
+
+
+def compute_agp(columns: ReadingColumns, start: datetime, end: datetime, bin_mins: int = AGP_BIN_MINS) -> AgpProfile:
+    n_bins = MINS_IN_DAY // bin_mins
+    readings = columns.reading_now[columns.reading_now > 0]
+    # stored minutes are local wall clock, so the minute of day is a plain modulo
+    bins = (as_minutes(columns.timestamp)[columns.reading_now > 0] % MINS_IN_DAY) // bin_mins
+    return AgpProfile(
+        start=start, end=end, bin_mins=bin_mins,
+        bin_starts=np.arange(n_bins) * bin_mins,
+        bands=binned_percentiles(bins, readings, n_bins),
+        n_readings=len(readings),
+        time_in_range=time_in_range(readings) if len(readings) else (0.0, 0.0, 0.0),
+    )
+
+
+def get_agp(sqldb: SqliteDatabase, start: datetime, end: datetime, bin_mins: int = AGP_BIN_MINS) -> AgpProfile:
+    return compute_agp(sqldb.main_table.fetch_columns(ts_start=start, ts_end=end), start, end, bin_mins=bin_mins)
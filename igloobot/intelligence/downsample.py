@@ -0,0 +1,44 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Indices of the `n_out` points Largest-Triangle-Three-Buckets keeps of (x, y), x ascending. The first and last
+    points are kept, and from each of the n_out - 2 buckets in between the point making the largest triangle with
+    the point kept from the bucket before and the mean of the bucket after. Unlike striding or averaging, peaks and
+    troughs survive.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x, y = x.astype(np.float64), y.astype(np.float64)
+
+    # bucket i is points [starts[i], ends[i]), splitting everything but the first and last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    # the bucket after the last one is the last point
+    next_starts, next_ends = np.append(starts[1:], n - 1), np.append(ends[1:], n)
+    cum_x, cum_y = np.concatenate(([0], np.cumsum(x))), np.concatenate(([0], np.cumsum(y)))
+    next_x = (cum_x[next_ends] - cum_x[next_starts]) / (next_ends - next_starts)
+    next_y = (cum_y[next_ends] - cum_y[next_starts]) / (next_ends - next_starts)
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    prev = 0
+    # each bucket depends on the point kept from the one before, so only the buckets themselves are vectorized
+    for bucket, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        area = np.abs((x[prev] - next_x[bucket]) * (y[start:end] - y[prev])
+                      - (x[prev] - x[start:end]) * (next_y[bucket] - y[prev]))
+        prev = start + int(np.argmax(area))
+        kept[bucket + 1] = prev
+    return kept
+
+
+def envelope(x: np.ndarray, low: np.ndarray, high: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(x, min of low, max of high) over `n_out` equal chunks of the points, so the extremes of every chunk show."""
+    if n_out >= len(x):
+        return x, low, high
+    chunk_starts = np.linspace(0, len(x), n_out, endpoint=False).astype(np.int64)
+    return x[chunk_starts], np.minimum.reduceat(low, chunk_starts), np.maximum.reduceat(high, chunk_starts)
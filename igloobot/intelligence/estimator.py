@@ -0,0 +1,142 @@
+import json
+import os
+from collections import deque
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from config.utils import ESTIMATOR_STATE_PATH
+from datastore.columnar import ReadingColumns
+from intelligence.projection import DEFAULT_MINS_IN_PAST, DEFAULT_MINS_IN_FUTURE, as_minutes
+
+# sums are kept relative to an origin, moved forward about once a day so t^2 stays well within float precision
+REBASE_AFTER_MINS = 24 * 60
+
+
+class StreamingTrendEstimator:
+    """
+    Least squares line through every reading of the last `window_mins` minutes, kept up to date in O(1) per reading
+    with running sums instead of re-reading the window. Uses every point of the window, so a single noisy reading
+    moves the projection less than the two point slopes of the windowed projection.
+    """
+    def __init__(self, window_mins: int = DEFAULT_MINS_IN_PAST):
+        self.window_mins = window_mins
+        self._points = deque()
+        self._origin = None
+        self._n = self._st = self._sy = self._stt = self._sty = 0.0
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def latest_ts(self) -> Optional[int]:
+        return self._points[-1][0] if self._points else None
+
+    @property
+    def latest_reading(self) -> Optional[int]:
+        return self._points[-1][1] if self._points else None
+
+    def _add(self, ts: int, reading: float, sign: int):
+        t = ts - self._origin
+        self._n += sign
+        self._st += sign * t
+        self._sy += sign * reading
+        self._stt += sign * t * t
+        self._sty += sign * t * reading
+
+    def _rebase(self, origin: int):
+        self._origin = origin
+        self._n = self._st = self._sy = self._stt = self._sty = 0.0
+        for ts, reading in self._points:
+            self._add(ts, reading, 1)
+
+    def update(self, ts: int, reading: int):
+        """Adds the reading at epoch minute `ts`, which must be newer than every reading seen so far."""
+        if self._points and ts <= self.latest_ts:
+            raise ValueError(f"Reading at {ts} is not newer than {self.latest_ts}")
+        if self._origin is None or ts - self._origin > REBASE_AFTER_MINS:
+            self._rebase(self._points[0][0] if self._points else ts)
+        self._points.append((ts, reading))
+        self._add(ts, reading, 1)
+        while self._points[0][0] < ts - self.window_mins:
+            old_ts, old_reading = self._points.popleft()
+            self._add(old_ts, old_reading, -1)
+
+    @property
+    def slope(self) -> float:
+        denominator = self._n * self._stt - self._st * self._st
+        if self._n < 2 or denominator <= 0:
+            return 0.0
+        return (self._n * self._sty - self._st * self._sy) / denominator
+
+    @property
+    def level(self) -> float:
+        """Fitted value at the latest reading."""
+        mean_t, mean_y = self._st / self._n, self._sy / self._n
+        return mean_y + self.slope * (self.latest_ts - self._origin - mean_t)
+
+    def projected(self, mins_in_future: int = DEFAULT_MINS_IN_FUTURE) -> int:
+        return int(self.level + self.slope * mins_in_future)
+
+    def projected_with_velocity(self, mins_in_future: int = DEFAULT_MINS_IN_FUTURE) -> Tuple[int, float]:
+        # velocity keeps the meaning of the stored column, projected change per minute from the present reading
+        projected = self.projected(mins_in_future)
+        return projected, (projected - self.latest_reading) / mins_in_future
+
+    @classmethod
+    def from_columns(cls, columns: ReadingColumns, window_mins: int = DEFAULT_MINS_IN_PAST) -> "StreamingTrendEstimator":
+        return cls(window_mins=window_mins).reseed(columns)
+
+    def reseed(self, columns: ReadingColumns) -> "StreamingTrendEstimator":
+        """Starts over, caught up to the last reading of `columns`. Only its last window is read."""
+        self._points.clear()
+        self._origin = None
+        ts_min = as_minutes(columns.timestamp)
+        if len(ts_min):
+            window_start = int(np.searchsorted(ts_min, ts_min[-1] - self.window_mins, side="left"))
+            for ts, reading in zip(ts_min[window_start:].tolist(), columns.reading_now[window_start:].tolist()):
+                self.update(ts, reading)
+        return self
+
+    def save(self, path: str = ESTIMATOR_STATE_PATH):
+        # the window is a handful of points, checkpointing them is enough to rebuild the sums exactly
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump({"window_mins": self.window_mins, "points": list(self._points)}, state_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = ESTIMATOR_STATE_PATH) -> Optional["StreamingTrendEstimator"]:
+        # a missing or damaged checkpoint is rebuilt from the stored readings by the caller
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+            estimator = cls(window_mins=state["window_mins"])
+            for ts, reading in state["points"]:
+                estimator.update(ts, reading)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return estimator
+
+
+def project_columns_streaming(columns: ReadingColumns, ref_ts: Optional[Sequence[int]] = None,
+                              mins_in_future: int = DEFAULT_MINS_IN_FUTURE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    project_columns with the StreamingTrendEstimator, replayed over the columns in order as the populator feeds it,
+    for the readings at `ref_ts` (epoch minutes) or all of them. The columns must reach DEFAULT_MINS_IN_PAST back
+    from the first reference reading.
+    """
+    ts_min = as_minutes(columns.timestamp)
+    wanted = np.ones(len(ts_min), dtype=bool) if ref_ts is None else np.isin(ts_min, ref_ts)
+    if ref_ts is not None and int(wanted.sum()) != len(ref_ts):
+        raise ValueError("Reference timestamps must all be present in the columns")
+    estimator = StreamingTrendEstimator()
+    projections = []
+    for ts, reading, keep in zip(ts_min.tolist(), columns.reading_now.tolist(), wanted.tolist()):
+        estimator.update(ts, reading)
+        if keep:
+            projections.append(estimator.projected_with_velocity(mins_in_future))
+    if not projections:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+    reading_20, velocity = zip(*projections)
+    return np.array(reading_20, dtype=np.float64), np.array(velocity, dtype=np.float64)
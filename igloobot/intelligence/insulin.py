@@ -0,0 +1,41 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List
+
+import numpy as np
+
+from config.utils import INSULIN_PROFILE_FLAT, INSULIN_PROFILE_LINEAR, LEGACY_INSULIN_SPREAD_MINS
+from datastore.primitives import IglooInsulinEvent
+
+# fraction of a dose still on board, per minute since the dose
+INSULIN_PROFILES = {
+    INSULIN_PROFILE_FLAT: np.ones(LEGACY_INSULIN_SPREAD_MINS),
+    INSULIN_PROFILE_LINEAR: np.linspace(1, 0, 4 * 60, endpoint=False),
+}
+MAX_INSULIN_ACTION_MINS = max(len(kernel) for kernel in INSULIN_PROFILES.values())
+
+
+def insulin_on_board(events: List[IglooInsulinEvent], grid_start: datetime, n_minutes: int) -> np.ndarray:
+    """
+    Insulin on board for every minute of [grid_start, grid_start + n_minutes), computed by convolving
+    the doses with their action profile. Events up to MAX_INSULIN_ACTION_MINS before grid_start
+    are needed for the start of the window to be correct.
+    """
+    grid_start = grid_start.replace(tzinfo=None, second=0, microsecond=0)
+    iob = np.zeros(n_minutes)
+
+    events_by_profile = defaultdict(list)
+    for event in events:
+        events_by_profile[event.profile].append(event)
+
+    for profile, profile_events in events_by_profile.items():
+        kernel = INSULIN_PROFILES[profile]
+        pad = len(kernel)
+        offsets = np.array([(ev.timestamp - grid_start) // timedelta(minutes=1) for ev in profile_events]) + pad
+        units = np.array([ev.units for ev in profile_events], dtype=float)
+        in_window = (offsets >= 0) & (offsets < n_minutes + pad)
+
+        doses = np.zeros(n_minutes + pad)
+        np.add.at(doses, offsets[in_window], units[in_window])
+        iob += np.convolve(doses, kernel)[pad:pad + n_minutes]
+    return iob
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+
+from config.utils import MEAL_BASELINE_MINS, MEAL_RESPONSE_MINS, MEAL_PENDING_LOOKBACK_MINS, MEAL_BACKFILL_BATCH_SIZE
+from datastore.primitives import SqliteDatabase, IglooMealResponse, fts_match_query
+from intelligence.primitives import DataProcessor
+
+
+def compute_meal_response(sqldb: SqliteDatabase, meal_ts: datetime, food_note: str,
+                          latest_ts: datetime) -> IglooMealResponse:
+    """
+    Glucose response to the meal at `meal_ts`, from the readings up to `latest_ts`.
+    Incomplete until the readings reach MEAL_RESPONSE_MINS after the meal, recomputed as they arrive.
+    """
+    processor = DataProcessor(
+        sqldb=sqldb,
+        start_datetime=meal_ts - timedelta(minutes=MEAL_BASELINE_MINS),
+        end_datetime=meal_ts + timedelta(minutes=MEAL_RESPONSE_MINS)
+    )
+    response = IglooMealResponse(timestamp=meal_ts, food_note=food_note,
+                                 complete=latest_ts >= processor.end_datetime)
+
+    columns = processor.columns
+    mins_after = (columns.timestamp - np.datetime64(response.timestamp, "m")) // np.timedelta64(1, "m")
+    readings = columns.reading_now.astype(np.float64)
+    before, after = mins_after <= 0, mins_after > 0
+    if before.any():
+        response.baseline = float(readings[before][-1])
+    if after.any():
+        peak_idx = int(np.argmax(readings[after]))
+        response.peak = int(readings[after][peak_idx])
+        response.time_to_peak = int(mins_after[after][peak_idx])
+        if response.baseline is not None:
+            # incremental area above the baseline, trapezoids between consecutive readings from the meal on
+            x = np.concatenate(([0], mins_after[after]))
+            y = np.clip(np.concatenate(([response.baseline], readings[after])) - response.baseline, 0, None)
+            response.auc = float(np.sum((y[1:] + y[:-1]) / 2 * np.diff(x)))
+
+    iob_ts, iob = processor.get_insulin_on_board_columns()
+    response.ins_on_board = float(iob[MEAL_BASELINE_MINS])
+    response.ins_dosed = float(sum(ev.units for ev in processor.insulin_events if ev.timestamp >= response.timestamp))
+    return response
+
+
+def update_meal_responses(sqldb: SqliteDatabase, latest_ts: Optional[datetime] = None,
+                          lookback_mins: int = MEAL_PENDING_LOOKBACK_MINS) -> int:
+    """
+    Computes the responses of new meals and of meals still inside their window, leaves finished ones alone.
+    Only meals of the last `lookback_mins` are looked at, so this stays cheap enough to run after every populator
+    insert even before the history has been backfilled, usually only the last meal or two are pending.
+    """
+    latest_ts = latest_ts or sqldb.main_table.fetch_latest_timestamp()
+    if latest_ts is None:
+        return 0
+    pending = sqldb.meal_responses_table.fetch_pending_meals(ts_start=latest_ts - timedelta(minutes=lookback_mins))
+    responses = [compute_meal_response(sqldb, meal_ts, food_note, latest_ts) for meal_ts, food_note in pending]
+    with sqldb.transaction():
+        sqldb.meal_responses_table.delete_orphans()
+        if responses:
+            sqldb.meal_responses_table.upsert_many(responses)
+    return len(responses)
+
+
+def backfill_meal_responses(sqldb: SqliteDatabase, ts_start: Optional[datetime] = None,
+                            ts_end: Optional[datetime] = None, batch_size: int = MEAL_BACKFILL_BATCH_SIZE) -> int:
+    """
+    Computes every pending meal response in [ts_start, ts_end], the whole history by default, `batch_size` meals
+    per transaction. Run once after upgrading, or after notes were edited outside the populator's lookback.
+    """
+    latest_ts = sqldb.main_table.fetch_latest_timestamp()
+    if latest_ts is None:
+        return 0
+    total = 0
+    with sqldb.transaction():
+        sqldb.meal_responses_table.delete_orphans()
+    while True:
+        pending = sqldb.meal_responses_table.fetch_pending_meals(ts_start=ts_start, ts_end=ts_end, limit=batch_size)
+        if not pending:
+            return total
+        responses = [compute_meal_response(sqldb, meal_ts, food_note, latest_ts) for meal_ts, food_note in pending]
+        with sqldb.transaction():
+            sqldb.meal_responses_table.upsert_many(responses)
+        total += len(responses)
+        print(f"Computed {total} meal responses, up to {pending[-1][0]}")
+        # incomplete meals stay pending, carry on after the last one instead of fetching them again
+        ts_start = pending[-1][0] + timedelta(minutes=1)
+
+
+def meal_response_summary(sqldb: SqliteDatabase, food_text: str) -> Dict[str, float]:
+    """How meals noted with `food_text` usually go, medians over every complete matching meal."""
+    match_query = fts_match_query(food_text)
+    responses = sqldb.meal_responses_table.fetch_matching(match_query) if match_query else []
+    summary = {"meals": len(responses)}
+    for metric in ("baseline", "rise", "time_to_peak", "auc", "ins_on_board", "ins_dosed"):
+        values = [getattr(r, metric) for r in responses if getattr(r, metric) is not None]
+        summary[metric] = float(np.median(values)) if values else None
+    return summary
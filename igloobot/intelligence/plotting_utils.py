@@ -1,22 +1,39 @@
-import os
-from dataclasses import dataclass
+import io
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
 from datetime import datetime
 from datetime import timedelta
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import matplotlib
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import numpy as np
 import pandas as pd
 
-from datastore.primitives import SqliteDatabase
+from datastore.primitives import get_database, fts_match_query
+from intelligence.agp import AgpProfile, get_agp
+from intelligence.downsample import lttb_indices, envelope
 from intelligence.primitives import DataProcessor
-from config.utils import get_current_time
+from intelligence.projection import as_minutes
+from intelligence.render_cache import get_render_cache, window_version
+from config.utils import get_current_time, from_epoch_minutes, MEAL_BASELINE_MINS, MEAL_RESPONSE_MINS, IN_RANGE, \
+    PLOT_PRESET, ROLLUP_RESOLUTIONS, DEFAULT_AGP_DAYS, DEFAULT_RANGE_DAYS, time_in_range
 
 matplotlib.use('agg')
 
 HOUR = 60
 DEFAULT_FOOD_SEARCH_WINDOW_HRS = 4
+DEFAULT_NOTE_SEARCH_LIMIT = 20
+FIGSIZE = (10, 6)
+# past this many minute readings, range plots are drawn from the finest rollup that stays under it
+RANGE_MAX_SOURCE_POINTS = 12 * 1024
+# minute tick intervals tried in order, past the last one ticks are left to AutoDateLocator
+MINUTE_TICK_INTERVALS = (10, 15, 30, 60)
+MAX_XTICKS = 30
 @dataclass
 class YLim:
     min: int = -50
@@ -34,11 +51,47 @@ class PlotConfig:
     aft_duration_min: int = 20
 
 
-FOOD_PLOT_CONFIG = PlotConfig(bef_duration_min=int(0.5 * HOUR), aft_duration_min=4 * HOUR)
+FOOD_PLOT_CONFIG = PlotConfig(bef_duration_min=MEAL_BASELINE_MINS, aft_duration_min=MEAL_RESPONSE_MINS)
+
+
+@dataclass(frozen=True)
+class RenderPreset:
+    dpi: int
+    format: str = "jpeg"
+    # passed on to pillow, e.g. jpeg/webp quality
+    pil_kwargs: Dict = field(default_factory=dict, hash=False)
+
+
+# the figures are 10x6 inches, so dpi 200 is 2000x1200. telegram scales photos down to 1280px anyway
+RENDER_PRESETS = {
+    "mobile": RenderPreset(dpi=200, format="jpeg", pil_kwargs={"quality": 85}),
+    "mobile_png": RenderPreset(dpi=160, format="png"),
+    "mobile_webp": RenderPreset(dpi=200, format="webp", pil_kwargs={"quality": 80}),
+    # what every plot used to be written as, 5000x3000
+    "hires": RenderPreset(dpi=500, format="jpeg"),
+}
+
+
+def get_render_preset(preset: Union[str, RenderPreset, None] = None) -> RenderPreset:
+    if isinstance(preset, RenderPreset):
+        return preset
+    return RENDER_PRESETS[preset or PLOT_PRESET]
+
+
+def render_figure(figure, preset: Union[str, RenderPreset, None] = None, output=None) -> bytes:
+    """
+    Encodes the figure. Written to `output` (a path or binary file) if given, returned as bytes
+    otherwise, so concurrent renders never share a file.
+    """
+    preset = get_render_preset(preset)
+    buffer = output if output is not None else io.BytesIO()
+    figure.savefig(buffer, format=preset.format, dpi=preset.dpi, pil_kwargs=preset.pil_kwargs or None)
+    return buffer.getvalue() if output is None else None
 
 
 def create_figure():
-    figure = plt.figure(figsize=(10, 6))
+    # not registered with pyplot, so figures of concurrent renders never see each other
+    figure = Figure(figsize=FIGSIZE)
     ax = figure.add_subplot(111)
     return figure, ax
 
@@ -63,6 +116,20 @@ def add_timestamp_xtick(axes, event_ts):
               color='purple', va="bottom", ha="right", fontsize=5, rotation=90)
 
 
+def add_timestamp_xticks(axes, events_ts):
+    """add_timestamp_xtick for every timestamp of `events_ts`."""
+    events_ts = pd.Series(events_ts)
+    add_texts(axes, events_ts, np.full(len(events_ts), YLim.min + 10), events_ts.dt.strftime('%H:%M'),
+              color='purple', va="bottom", ha="right", fontsize=5, rotation=90)
+
+
+def add_texts(axes, xpts, ypts, labels, color='purple', fontsize=6, rotation=0, ha="left", va="bottom"):
+    """axes.text for every (xpts, ypts, labels), left out of the layout, which does not depend on them."""
+    for xpt, ypt, label in zip(xpts, ypts, labels):
+        text = axes.text(xpt, ypt, str(label), color=color, fontsize=fontsize, rotation=rotation, ha=ha, va=va)
+        text.set_in_layout(False)
+
+
 def sanitize(ds, ts):
     zero_indices = ds[ds == 0].index
     ds = ds.drop(zero_indices)
@@ -71,12 +138,12 @@ def sanitize(ds, ts):
 
 
 def plot_text_events(axes, ts_series, data_series, y_height=60):
-    for idx, val in enumerate(data_series):
-        ts = ts_series[idx]
-        if val:
-            add_vline(axes, xpt=ts)
-            axes.text(x=ts, y=y_height, s=val, color='purple', fontsize=6, va="bottom", ha="right", rotation=90)
-            add_timestamp_xtick(axes, ts)
+    has_event = data_series.astype(bool).to_numpy()
+    events_ts, events = ts_series[has_event], data_series[has_event]
+    add_vlines(axes, xpts=events_ts)
+    add_texts(axes, events_ts, np.full(len(events), y_height), events,
+              color='purple', fontsize=6, va="bottom", ha="right", rotation=90)
+    add_timestamp_xticks(axes, events_ts)
 
 
 def plot_series(axes, ts_series, data_series, marker='o', markersize=0.35, linewidth=0.25, color='g', zeros_ok=False,
@@ -94,30 +161,40 @@ def plot_series(axes, ts_series, data_series, marker='o', markersize=0.35, linew
 
 def plot_fill_series(axes, ts_series, data_series, scale, color='#ffeff8', alpha=0.99):
     axes.fill_between(ts_series, data_series * scale, color=color, alpha=alpha)
-    prev_val = 0
-
-    data_series = data_series[::-1].reset_index(drop=True)
-    ts_series = ts_series[::-1].reset_index(drop=True)
-    for idx, _ in enumerate(data_series):
-        event_idx = idx
-        event_ts = ts_series[event_idx]
-        event_val = data_series[event_idx]
-        if event_val > 0 and event_val != prev_val:
-            axes.text(x=event_ts, y=event_val * scale, s=f"{int(event_val)}u",
-                      color='purple', va="top", ha="right", fontsize=5, rotation=45)
-            if idx:  # to avoid adding line at first element
-                add_vline(axes, xpt=event_ts)
-                add_timestamp_xtick(axes, event_ts)
-        elif (event_val == 0 and event_val != prev_val) or idx == len(data_series) - 1:
-            # insulin ended
-            add_vline(axes, xpt=event_ts)
-            add_timestamp_xtick(axes, event_ts)
-        prev_val = event_val
-
-
-def decorate_axes(axes):
-    axes.xaxis.set_major_locator(mdates.MinuteLocator(interval=10))
-    axes.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    if not len(data_series):
+        return
+
+    # oldest first, every change of value is an event
+    values = data_series.to_numpy()[::-1]
+    timestamps = ts_series.to_numpy()[::-1]
+    changed = np.diff(values, prepend=0) != 0
+    started = changed & (values > 0)
+    # insulin ended, or the end of the window
+    ended = (changed & (values == 0)) | ((np.arange(len(values)) == len(values) - 1) & ~started)
+
+    add_texts(axes, timestamps[started], values[started] * scale, [f"{int(val)}u" for val in values[started]],
+              color='purple', va="top", ha="right", fontsize=5, rotation=45)
+    started[0] = False  # to avoid adding line at first element
+    lines_ts = timestamps[started | ended]
+    add_vlines(axes, xpts=lines_ts)
+    add_timestamp_xticks(axes, lines_ts)
+
+
+def decorate_xaxis(axes, span: timedelta = None):
+    # a tick every 10 minutes for the usual few hours, fewer as the span grows
+    span_mins = span // timedelta(minutes=1) if span is not None else 0
+    minute_intervals = [interval for interval in MINUTE_TICK_INTERVALS if span_mins / interval <= MAX_XTICKS]
+    if minute_intervals:
+        axes.xaxis.set_major_locator(mdates.MinuteLocator(interval=minute_intervals[0]))
+        axes.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    else:
+        locator = mdates.AutoDateLocator(minticks=6, maxticks=14)
+        axes.xaxis.set_major_locator(locator)
+        axes.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+
+
+def decorate_axes(axes, span: timedelta = None):
+    decorate_xaxis(axes, span=span)
 
     # Format y-axis
     axes.yaxis.set_major_locator(plt.MultipleLocator(20))
@@ -138,6 +215,12 @@ def add_vline(axes, xpt, ypt=None, text="", color='g', linestyle='--', lw=0.6):
     axes.axvline(xpt, color=color, linestyle=linestyle, lw=lw)
 
 
+def add_vlines(axes, xpts, color='g', linestyle='--', lw=0.6):
+    """add_vline for every point, drawn as a single LineCollection."""
+    if len(xpts):
+        axes.vlines(xpts, 0, 1, transform=axes.get_xaxis_transform(), colors=color, linestyles=linestyle, lw=lw)
+
+
 def add_hline(axes, ypt, color='r', linestyle='--', lw=0.6):
     axes.axhline(ypt, color=color, linestyle=linestyle, lw=lw)
 
@@ -156,105 +239,350 @@ def annotate_plot(axes):
     axes.axhspan(-10.0, 10.0, color='lightgreen', alpha=0.3, zorder=99)
 
 
-def create_plot(data_to_plot):
-    df_dtp_raw = pd.DataFrame([vars(obj) for obj in data_to_plot])
-    df_dtp_raw['timestamp'] = pd.to_datetime(df_dtp_raw['timestamp'])
-    df_dtp_raw = df_dtp_raw.sort_values(by='timestamp', ascending=False)
+class FigureTemplate:
+    """
+    A figure with its static decoration (axes, range bands, y ticks, labels) built once per process and reused by
+    every render of one kind. Renders only add their data artists, removed again once encoded, and the layout
+    tight_layout works out on the first render is kept for the following ones.
+    """
+    def __init__(self, decorate: Callable):
+        self.figure, self.axes = create_figure()
+        decorate(self.axes)
+        self._static_artists = set(self.axes.get_children())
+        self._laid_out = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, span: timedelta = None):
+        """The figure and axes to draw one render on, for one caller at a time."""
+        with self._lock:
+            decorate_xaxis(self.axes, span=span)
+            try:
+                yield self.figure, self.axes
+            finally:
+                self._clear()
+
+    def render(self, preset: Union[str, RenderPreset, None] = None, output=None) -> Optional[bytes]:
+        if not self._laid_out:
+            self.figure.tight_layout()
+            self._laid_out = True
+        return render_figure(self.figure, preset=preset, output=output)
+
+    def _clear(self):
+        for artist in self.axes.get_children():
+            if artist not in self._static_artists:
+                artist.remove()
+        self.axes.set_title("")
+        # data limits are rebuilt from the static artists alone, the next render autoscales x afresh
+        self.axes.relim()
+        self.axes.set_autoscalex_on(True)
+
+
+def decorate_timeline(axes):
+    decorate_axes(axes)
+    annotate_plot(axes)
+
+
+# kinds of plots, each reusing its own figure. the same decoration, but not the same layout
+FIGURE_TEMPLATES = {
+    "timeline": decorate_timeline,
+    "range": decorate_timeline,
+}
+
+
+@lru_cache(maxsize=None)
+def get_figure_template(kind: str) -> FigureTemplate:
+    return FigureTemplate(FIGURE_TEMPLATES[kind])
+
+
+def create_combined_df(processor: DataProcessor) -> pd.DataFrame:
+    """Readings, notes and insulin on board of the processor's window, joined on timestamp, newest first."""
+    combined_df = processor.get_combined_columns().to_frame()
+    return combined_df.iloc[::-1].reset_index(drop=True)
+
+
+def create_plot(data_to_plot, preset: Union[str, RenderPreset, None] = None, output=None) -> Optional[bytes]:
+    if isinstance(data_to_plot, pd.DataFrame):
+        df_dtp_raw = data_to_plot
+    else:
+        df_dtp_raw = pd.DataFrame([vars(obj) for obj in data_to_plot])
+        df_dtp_raw['timestamp'] = pd.to_datetime(df_dtp_raw['timestamp'])
+    df_dtp_raw = df_dtp_raw.sort_values(by='timestamp', ascending=False).reset_index(drop=True)
 
     df_dtp = df_dtp_raw  # remove_empty_from_df(df_dtp_raw)
 
     # Plot
-    figure, ax = create_figure()
-    decorate_axes(ax)
-    annotate_plot(ax)
-
-    # plot current reading and velocity
-    plot_series(ax, df_dtp['timestamp'], df_dtp['reading_now'])
-    plot_series(ax, df_dtp['timestamp'], df_dtp['velocity'] * 10, show_last_text=False)
+    template = get_figure_template("timeline")
+    with template.use(span=df_dtp['timestamp'].max() - df_dtp['timestamp'].min()) as (figure, ax):
+        # plot current reading and velocity
+        plot_series(ax, df_dtp['timestamp'], df_dtp['reading_now'])
+        plot_series(ax, df_dtp['timestamp'], df_dtp['velocity'] * 10, show_last_text=False)
 
-    # create a future df with values from 20 minutes
-    future_df = create_future_df(df_dtp)
+        # create a future df with values from 20 minutes
+        future_df = create_future_df(df_dtp)
 
-    # to display timestamp of last value of future_df
-    max_ts_w_value = remove_empty_from_df(df_dtp)['timestamp'].max()
-    ax.axvspan(max_ts_w_value, future_df['timestamp'].max(),
-               facecolor='none', edgecolor='k', hatch='\\\\', alpha=0.05, zorder=99.1)
+        # to display timestamp of last value of future_df
+        max_ts_w_value = remove_empty_from_df(df_dtp)['timestamp'].max()
+        ax.axvspan(max_ts_w_value, future_df['timestamp'].max(),
+                   facecolor='none', edgecolor='k', hatch='\\\\', alpha=0.05, zorder=99.1)
 
-    # plot future_df
-    plot_series(ax, future_df['timestamp'], future_df['reading_now'], color='r')
+        # plot future_df
+        plot_series(ax, future_df['timestamp'], future_df['reading_now'], color='r')
 
-    INS_CARB_SCALE = 14
-    # IRL is (50), However, having it plot like that does not add value. Let's change to 14;
-    # Assuming maximum ins input at a time of 25 we get scale of 350, which also corresponds to ins range.
-    plot_fill_series(ax, df_dtp['timestamp'], df_dtp['ins_units'], scale=INS_CARB_SCALE, color='r', alpha=0.25)
+        INS_CARB_SCALE = 14
+        # IRL is (50), However, having it plot like that does not add value. Let's change to 14;
+        # Assuming maximum ins input at a time of 25 we get scale of 350, which also corresponds to ins range.
+        plot_fill_series(ax, df_dtp['timestamp'], df_dtp['ins_units'], scale=INS_CARB_SCALE, color='r', alpha=0.25)
 
-    plot_text_events(ax, df_dtp['timestamp'], df_dtp['food_note'], y_height=120)
+        plot_text_events(ax, df_dtp['timestamp'], df_dtp['food_note'], y_height=120)
 
-    plot_text_events(ax, df_dtp['timestamp'], df_dtp['misc_note'])
+        plot_text_events(ax, df_dtp['timestamp'], df_dtp['misc_note'])
 
-    figure.tight_layout()
-    plt_filepath = os.path.join(os.getcwd(), "output.jpg")
-    figure.savefig(plt_filepath, dpi=500)
-    plt.close(figure)
-    return plt_filepath
+        return template.render(preset=preset, output=output)
 
 
-def _plot(request_time: datetime, plot_config: PlotConfig = PlotConfig()) -> str:
+def _plot(request_time: datetime, plot_config: PlotConfig = PlotConfig(),
+          preset: Union[str, RenderPreset, None] = None) -> Optional[bytes]:
     # mins_in_future is needed for events in ahead_mins
     # mins_in_past is needed to set lookback duration
 
-    sqldb = SqliteDatabase()
-    _processor = DataProcessor(
-        sqldb=sqldb,
-        end_datetime=request_time + timedelta(minutes=plot_config.aft_duration_min),
-        start_datetime=request_time - timedelta(minutes=plot_config.bef_duration_min)
+    sqldb = get_database()
+    start_datetime = request_time.replace(tzinfo=None, second=0, microsecond=0) - timedelta(
+        minutes=plot_config.bef_duration_min)
+    end_datetime = request_time.replace(tzinfo=None, second=0, microsecond=0) + timedelta(
+        minutes=plot_config.aft_duration_min)
+    preset = get_render_preset(preset)
+    cache_key = get_render_cache().make_key(
+        "plot", start_datetime, end_datetime, plot_config, preset, window_version(sqldb, start_datetime, end_datetime)
     )
-    if not _processor.data:
-        print("no data in requested time range")
-        return None
 
-    data_to_plot = _processor.get_combined_data()
-    return create_plot(data_to_plot=data_to_plot)
+    def render():
+        _processor = DataProcessor(sqldb=sqldb, end_datetime=end_datetime, start_datetime=start_datetime)
+        if not len(_processor.columns):
+            print("no data in requested time range")
+            return None
+        data_to_plot = create_combined_df(_processor)
+        return create_plot(data_to_plot=data_to_plot, preset=preset)
+
+    return get_render_cache().get_or_render(cache_key, render)
 
 
 def search_food_str(
-        request_time: datetime = get_current_time(),
+        request_time: datetime = None,
         food_item_to_search: str = None,
         food_search_window_hrs: int = None
 ) -> List[UpdatesRowIdentifier]:
-    sqldb = SqliteDatabase()
+    sqldb = get_database()
+    request_time = request_time or get_current_time()
     food_search_window_hrs = food_search_window_hrs or DEFAULT_FOOD_SEARCH_WINDOW_HRS
     start_time = request_time - timedelta(hours=food_search_window_hrs)
+    if food_item_to_search:
+        # indexed, so wide windows are as cheap as the default one
+        _results = search_notes(food_item_to_search, ts_start=start_time, ts_end=request_time, column="food_note",
+                                by_rank=False, limit=-1)
+        print(_results or f"Did not find food {food_item_to_search}")
+        return _results
+
     _processor = DataProcessor(sqldb=sqldb, end_datetime=request_time, start_datetime=start_time)
-    combined_data = _processor.get_combined_data()
+    updates = _processor.update_columns
 
     _results: List[UpdatesRowIdentifier] = []
-    for comb_el in combined_data:
-        if comb_el.food_note and (not food_item_to_search or food_item_to_search in comb_el.food_note):
-            print(f"Found food {comb_el.food_note} at {comb_el.timestamp}")
+    for ts, food_note, upd_rowid in zip(updates.timestamp[::-1].astype(datetime), updates.food_note[::-1],
+                                        updates.upd_rowid[::-1]):
+        if food_note:
+            print(f"Found food {food_note} at {ts}")
             row_iden = UpdatesRowIdentifier(
-                timestamp=comb_el.timestamp,
-                row_id=comb_el.upd_rowid
+                timestamp=ts,
+                row_id=int(upd_rowid)
             )
             _results.append(row_iden)
-    print(_results or f"Did not find food {food_item_to_search or ''}")
+    print(_results or "Did not find food")
     return _results
 
-def plot_default():
-    return _plot(request_time=get_current_time())
+def create_agp_plot(agp: AgpProfile, preset: Union[str, RenderPreset, None] = None, output=None) -> Optional[bytes]:
+    figure, ax = create_figure()
+    hours = np.append(agp.bin_starts, 24 * HOUR) / HOUR
+    # repeat the last bin so the bands reach midnight
+    bands = np.concatenate((agp.bands, agp.bands[:, :1]), axis=1)
+    p5, p25, p50, p75, p95 = bands
+
+    ax.axhspan(IN_RANGE[0], IN_RANGE[-1] + 1, color='lightgreen', alpha=0.3)
+    ax.fill_between(hours, p5, p95, color='#9ecae1', alpha=0.5, lw=0, label='5-95%')
+    ax.fill_between(hours, p25, p75, color='#3182bd', alpha=0.5, lw=0, label='25-75%')
+    ax.plot(hours, p50, color='#08306b', lw=1.2, label='median')
+
+    ax.set_xlim(0, 24)
+    ax.xaxis.set_major_locator(plt.MultipleLocator(3))
+    ax.xaxis.set_major_formatter(plt.FuncFormatter(lambda hour, _: f"{int(hour):02d}:00"))
+    ax.set_ylim(0, YLim.max)
+    ax.yaxis.set_major_locator(plt.MultipleLocator(50))
+    ax.grid(which='major', color='grey', linestyle=':', linewidth=0.3)
+    ax.set_xlabel('time of day')
+    ax.set_ylabel('readings')
+    below, in_range, above = agp.time_in_range
+    ax.set_title(f"{agp.start:%d %b} - {agp.end:%d %b %Y}, {agp.n_readings} readings, "
+                 f"below {below:.0f}% / in range {in_range:.0f}% / above {above:.0f}%", fontsize=9)
+    ax.legend(loc='upper right', fontsize=7)
+
+    figure.tight_layout()
+    return render_figure(figure, preset=preset, output=output)
+
+
+def plot_agp(start: datetime = None, end: datetime = None, days: int = DEFAULT_AGP_DAYS,
+             preset: Union[str, RenderPreset, None] = None) -> Optional[bytes]:
+    """Ambulatory glucose profile of [start, end], the last `days` days by default."""
+    sqldb = get_database()
+    end = end or get_current_time().replace(tzinfo=None, second=0, microsecond=0)
+    start = start or end - timedelta(days=days)
+    preset = get_render_preset(preset)
+    cache_key = get_render_cache().make_key(
+        "agp", start, end, preset, window_version(sqldb, start, end, readings_only=True)
+    )
+
+    def render():
+        agp = get_agp(sqldb, start=start, end=end)
+        if not agp.n_readings:
+            print("no data in requested time range")
+            return None
+        return create_agp_plot(agp, preset=preset)
+
+    return get_render_cache().get_or_render(cache_key, render)
+
+
+@dataclass
+class RangeSeries:
+    start: datetime
+    end: datetime
+    timestamps: np.ndarray
+    readings: np.ndarray
+    # lowest and highest reading behind each point, the readings themselves unless read from rollups
+    low: np.ndarray
+    high: np.ndarray
+    # (below, in range, above) percentages
+    time_in_range: Tuple[float, float, float]
+
+
+def fetch_range_series(sqldb, start: datetime, end: datetime) -> RangeSeries:
+    """
+    Readings of [start, end], the minute readings while there are few enough of them. Otherwise the finest rollup
+    that keeps under RANGE_MAX_SOURCE_POINTS, its means as readings and its min/max as low/high.
+    """
+    span_mins = (end - start) // timedelta(minutes=1)
+    if span_mins <= RANGE_MAX_SOURCE_POINTS:
+        columns = sqldb.main_table.fetch_columns(ts_start=start, ts_end=end)
+        readings = columns.reading_now[columns.reading_now > 0]
+        return RangeSeries(start=start, end=end, timestamps=columns.timestamp[columns.reading_now > 0],
+                           readings=readings, low=readings, high=readings,
+                           time_in_range=time_in_range(readings) if len(readings) else (0.0, 0.0, 0.0))
+
+    resolution = next((res for res in ROLLUP_RESOLUTIONS if span_mins / res <= RANGE_MAX_SOURCE_POINTS),
+                      ROLLUP_RESOLUTIONS[-1])
+    rollups = sqldb.rollups_table.fetch_columns(resolution, ts_start=start, ts_end=end)
+    has_reading = rollups.count > 0
+    very_low, low, in_range, high, very_high = rollups.total().range_percentages[0].tolist() if len(rollups) else [0.0] * 5
+    return RangeSeries(
+        start=start, end=end,
+        # drawn at the middle of each bucket
+        timestamps=rollups.timestamp[has_reading] + np.timedelta64(resolution // 2, "m"),
+        readings=rollups.mean[has_reading], low=rollups.min[has_reading], high=rollups.max[has_reading],
+        time_in_range=(very_low + low, in_range, high + very_high),
+    )
+
+
+def create_range_plot(series: RangeSeries, preset: Union[str, RenderPreset, None] = None,
+                      output=None) -> Optional[bytes]:
+    """
+    Readings over days or weeks, downsampled to about the image's pixel width with LTTB, which keeps the highs and
+    lows, over the min/max envelope of the same points. Draws the same number of points whatever the span.
+    """
+    preset = get_render_preset(preset)
+    n_out = int(FIGSIZE[0] * preset.dpi)
+    kept = lttb_indices(as_minutes(series.timestamps), series.readings, n_out)
+    band_ts, band_low, band_high = envelope(series.timestamps, series.low, series.high, n_out)
+
+    template = get_figure_template("range")
+    with template.use(span=series.end - series.start) as (figure, ax):
+        ax.fill_between(band_ts, band_low, band_high, color='g', alpha=0.15, lw=0, step='post')
+        ax.plot(series.timestamps[kept], series.readings[kept], color='g', linewidth=0.5)
+        ax.set_xlim(series.start, series.end)
+        below, in_range, above = series.time_in_range
+        ax.set_title(f"{series.start:%d %b} - {series.end:%d %b %Y}, "
+                     f"below {below:.0f}% / in range {in_range:.0f}% / above {above:.0f}%", fontsize=9)
+        return template.render(preset=preset, output=output)
+
+
+def plot_range(start: datetime = None, end: datetime = None, days: int = DEFAULT_RANGE_DAYS,
+               preset: Union[str, RenderPreset, None] = None) -> Optional[bytes]:
+    """Readings of [start, end] on one plot, the last `days` days by default."""
+    sqldb = get_database()
+    end = end or get_current_time().replace(tzinfo=None, second=0, microsecond=0)
+    start = start or end - timedelta(days=days)
+    preset = get_render_preset(preset)
+    cache_key = get_render_cache().make_key(
+        "range", start, end, preset, window_version(sqldb, start, end, readings_only=True)
+    )
+
+    def render():
+        series = fetch_range_series(sqldb, start, end)
+        if not len(series.readings):
+            print("no data in requested time range")
+            return None
+        return create_range_plot(series, preset=preset)
+
+    return get_render_cache().get_or_render(cache_key, render)
+
+
+def search_notes(text: str, ts_start: datetime = None, ts_end: datetime = None, column: str = None,
+                 by_rank: bool = True, limit: int = DEFAULT_NOTE_SEARCH_LIMIT) -> List[UpdatesRowIdentifier]:
+    """
+    Food and misc notes containing every word of `text`, words matching as prefixes ('bre' finds 'bread').
+    Searches the whole history unless limited to [ts_start, ts_end] or to one `column`, best match first.
+    """
+    match_query = fts_match_query(text, column=column)
+    if match_query is None:
+        return []
+    records = get_database().updates_table.search(match_query, ts_start=ts_start, ts_end=ts_end, by_rank=by_rank,
+                                                  limit=limit)
+    return [UpdatesRowIdentifier(timestamp=from_epoch_minutes(rowid), row_id=rowid) for rowid, _, _ in records]
+
+
+def default_request_time(plot_config: PlotConfig = PlotConfig()) -> datetime:
+    """
+    The latest reading while it is still within the plotted future, so the default plot only moves when new data
+    comes in and whoever asks before that gets the same (cached) render.
+    """
+    current_time = get_current_time().replace(tzinfo=None, second=0, microsecond=0)
+    latest_ts = get_database().main_table.fetch_latest_timestamp()
+    if latest_ts is not None and timedelta(0) <= current_time - latest_ts <= timedelta(minutes=plot_config.aft_duration_min):
+        return latest_ts
+    return current_time
+
+
+def plot_default(preset: Union[str, RenderPreset, None] = None) -> Optional[bytes]:
+    return _plot(request_time=default_request_time(), preset=preset)
+
+
+def prerender_default_plot():
+    """Run in a render worker after new data is committed, so the next request for the default plot is a cache hit."""
+    try:
+        plot_default()
+    except Exception as exc:
+        print(f"Pre-rendering the default plot failed. Exception = {exc}")
 
 
-def plot_specific(request_id: int = None, event_time: datetime = None, plot_config: PlotConfig = PlotConfig()):
+def plot_specific(request_id: int = None, event_time: datetime = None, plot_config: PlotConfig = PlotConfig(),
+                  preset: Union[str, RenderPreset, None] = None) -> Optional[bytes]:
     assert (request_id is None) != (event_time is None)
 
-    sqldb = SqliteDatabase()
+    sqldb = get_database()
     if request_id is not None:
         updates_row = sqldb.updates_table.fetch_w_rowid(rowid=request_id)
     else:
         updates_row = sqldb.updates_table.fetch_w_ts(timestamp=event_time)
     return _plot(
         request_time=updates_row.timestamp,
-        plot_config=plot_config
+        plot_config=plot_config,
+        preset=preset
     )
 
 
@@ -263,4 +591,7 @@ if __name__ == '__main__':
     # if food_events and len(food_events) == 1:
     #     plot_specific(event_time=food_events[0].timestamp, plot_config=FOOD_PLOT_CONFIG)
 
-    plot_default()
+    image = plot_default(preset="hires")
+    if image:
+        with open("output.jpg", "wb") as image_file:
+            image_file.write(image)
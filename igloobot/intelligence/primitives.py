@@ -2,16 +2,22 @@ import warnings
 from dataclasses import dataclass, field
 from datetime import datetime
 from datetime import timedelta
-from typing import List, Union, Optional
+from functools import cached_property
+from typing import List, Union, Optional, Dict, Tuple
 
 import numpy as np
 
-from config.utils import is_out_of_range, VAL_CURRENT, TIMESTAMP_FORMAT
-from datastore.primitives import SqliteDatabase, IglooDataElement, IglooUpdatesElement, parse_timestamp
+from config.utils import out_of_range_mask, VAL_CURRENT, TIMESTAMP_FORMAT, PROJECTION_METHOD, PROJECTION_STREAMING
+from datastore.columnar import ReadingColumns, UpdatesColumns, TimelineColumns, to_datetime64, to_datetimes
+from datastore.primitives import SqliteDatabase, IglooDataElement, IglooUpdatesElement, IglooInsulinEvent, \
+    parse_timestamp
+from intelligence.estimator import StreamingTrendEstimator
+from intelligence.insulin import insulin_on_board, MAX_INSULIN_ACTION_MINS
+from intelligence.projection import DEFAULT_MINS_IN_PAST, DEFAULT_MINS_IN_FUTURE, as_minutes, window_slopes, \
+    project, project_columns
+from intelligence.ringbuffer import ReadingsRingBuffer
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
-DEFAULT_MINS_IN_PAST = 15
-DEFAULT_MINS_IN_FUTURE = 20
 DEFAULT_RECALL_PERIOD_IN_MINS = 60
 
 @dataclass
@@ -59,15 +65,50 @@ class DataProcessor:
     # for computing projections
     for_compute_default_mins_in_future: int = DEFAULT_MINS_IN_FUTURE
     for_compute_default_mins_in_past: int = DEFAULT_MINS_IN_PAST
+    # recent readings kept in memory, windows it covers are served without touching the db
+    buffer: Optional[ReadingsRingBuffer] = None
+    projection_method: str = PROJECTION_METHOD
+    # a long lived estimator already fed up to the present reading, one is built from the window otherwise
+    estimator: Optional[StreamingTrendEstimator] = None
 
     def __post_init__(self):
         self.start_datetime = self.start_datetime or self.end_datetime - timedelta(minutes=DEFAULT_RECALL_PERIOD_IN_MINS)
         # print(f"Creating DataProcessor from {start_datetime} to {self.data_until}")
-        self.data = self.sqldb.main_table.fetch_w_ts_range(ts_start=self.start_datetime, ts_end=self.end_datetime)
-        self.updates = self.sqldb.updates_table.fetch_w_ts_range(ts_start=self.start_datetime, ts_end=self.end_datetime)
 
     @property
+    def from_buffer(self) -> bool:
+        return self.buffer is not None and self.buffer.covers(self.start_datetime)
+
+    @cached_property
+    def data(self) -> List[IglooDataElement]:
+        if self.from_buffer:
+            cols = self.columns
+            return [
+                IglooDataElement(timestamp=ts, reading_now=int(r_now), reading_20=float(r_20), velocity=float(velo))
+                for ts, r_now, r_20, velo in zip(to_datetimes(cols.timestamp[::-1]), cols.reading_now[::-1],
+                                                 cols.reading_20[::-1], cols.velocity[::-1])
+            ]
+        return self.sqldb.main_table.fetch_w_ts_range(ts_start=self.start_datetime, ts_end=self.end_datetime)
+
+    @cached_property
+    def updates(self) -> List[IglooUpdatesElement]:
+        return self.sqldb.updates_table.fetch_w_ts_range(ts_start=self.start_datetime, ts_end=self.end_datetime)
+
+    @cached_property
+    def columns(self) -> ReadingColumns:
+        # columnar view of the readings, for callers that work on whole arrays
+        if self.from_buffer:
+            return self.buffer.columns(ts_start=self.start_datetime, ts_end=self.end_datetime)
+        return self.sqldb.main_table.fetch_columns(ts_start=self.start_datetime, ts_end=self.end_datetime)
+
+    @cached_property
+    def update_columns(self) -> UpdatesColumns:
+        return self.sqldb.updates_table.fetch_columns(ts_start=self.start_datetime, ts_end=self.end_datetime)
+
+    @cached_property
     def projected_reading(self):
+        if self.projection_method == PROJECTION_STREAMING:
+            return self.get_estimated_val_inner(mins_in_future=self.for_compute_default_mins_in_future)
         return self.get_avg_projected_val_inner(mins_in_future=self.for_compute_default_mins_in_future)
 
     @property
@@ -86,43 +127,82 @@ class DataProcessor:
     def present_velocity(self):
         return (self.projected_reading - self.present_reading) / self.for_compute_default_mins_in_future
 
+    @cached_property
+    def insulin_events(self) -> List[IglooInsulinEvent]:
+        # doses from before the window can still be on board at its start
+        return self.sqldb.insulin_table.fetch_w_ts_range(
+            ts_start=self.start_datetime - timedelta(minutes=MAX_INSULIN_ACTION_MINS),
+            ts_end=self.end_datetime
+        )
+
+    def get_insulin_on_board_columns(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(minute timestamps, insulin on board) covering every minute of the window."""
+        grid_start, grid_end = to_datetime64(self.start_datetime), to_datetime64(self.end_datetime)
+        n_minutes = int((grid_end - grid_start) // np.timedelta64(1, "m")) + 1
+        iob = insulin_on_board(self.insulin_events, grid_start=grid_start.astype(datetime), n_minutes=n_minutes)
+        return grid_start + np.arange(n_minutes), iob
+
+    def get_insulin_on_board(self) -> Dict[datetime, float]:
+        """Insulin on board for each minute of the window that has any."""
+        timestamps, iob = self.get_insulin_on_board_columns()
+        nonzero = np.flatnonzero(iob)
+        return dict(zip(timestamps[nonzero].astype(datetime), iob[nonzero].tolist()))
+
     def get_combined_data(self, reverse=True) -> List[CombinedElement]:
-        data_dict = {element.timestamp: element for element in self.data}
-        updates_dict = {element.timestamp: element for element in self.updates}
+        iob_dict = self.get_insulin_on_board()
         combined_elements_list = []
-        for ts in set(updates_dict.keys()).union(data_dict.keys()):
-            com_el = CombinedElement(timestamp=ts)
-            com_el.populate(
-                data_el=data_dict.get(ts, None),
-                update_el=updates_dict.get(ts, None)
-            )
-            combined_elements_list.append(com_el)
-
-        sorted_list = sorted(combined_elements_list, key=lambda cel: cel.timestamp, reverse=reverse)
-        return sorted_list
+        for ts, reading_now, reading_20, velocity, food_note, misc_note, upd_rowid in self.sqldb.iter_timeline(
+                ts_start=self.start_datetime, ts_end=self.end_datetime, descending=reverse):
+            combined_elements_list.append(CombinedElement(
+                timestamp=ts, ins_units=iob_dict.pop(ts, 0), food_note=food_note, misc_note=misc_note,
+                reading_now=reading_now, reading_20=reading_20, velocity=velocity, upd_rowid=upd_rowid
+            ))
+        if iob_dict:
+            # minutes that only have insulin on board, both runs are already sorted so this sort is a single merge
+            combined_elements_list.extend(CombinedElement(timestamp=ts, ins_units=units) for ts, units in iob_dict.items())
+            combined_elements_list.sort(key=lambda cel: cel.timestamp, reverse=reverse)
+        return combined_elements_list
+
+    def get_combined_columns(self) -> TimelineColumns:
+        """get_combined_data as columns in ascending order, insulin on board filled in for every minute that has any."""
+        timeline = self.sqldb.fetch_timeline_columns(ts_start=self.start_datetime, ts_end=self.end_datetime)
+        iob_ts, iob = self.get_insulin_on_board_columns()
+        timeline = timeline.with_timestamps(iob_ts[iob != 0])
+        # the insulin grid has one slot per minute of the window, so every row maps to its slot directly
+        grid_idx = (timeline.timestamp - iob_ts[0]) // np.timedelta64(1, "m")
+        timeline.ins_units = iob[grid_idx]
+        return timeline
+
+    @cached_property
+    def _projection_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (epoch minutes, readings, index of the present reading)
+        ts_min = as_minutes(self.columns.timestamp)
+        return ts_min, self.columns.reading_now, np.array([len(ts_min) - 1])
+
+    def get_projections(self, ref_ts: Optional[List[datetime]] = None,
+                        mins_in_future: int = DEFAULT_MINS_IN_FUTURE) -> Tuple[np.ndarray, np.ndarray]:
+        """(reading_20, velocity) arrays for the readings at `ref_ts`, or for every reading in the window."""
+        ref_min = None if ref_ts is None else [to_datetime64(ts).astype(np.int64) for ts in ref_ts]
+        return project_columns(self.columns, ref_ts=ref_min, mins_in_future=mins_in_future)
 
     def get_slope_inner(self, mins_in_past):
-        window_data = get_last(self.data, minutes=mins_in_past)
-        y_curr = window_data[0].reading_now
-        y_prev = window_data[-1].reading_now
-        return (y_curr - y_prev) / mins_in_past
+        ts_min, readings, present_idx = self._projection_arrays
+        return float(window_slopes(ts_min, readings, present_idx, windows=[mins_in_past])[0, 0])
 
     def get_projected_val_inner(self, mins_in_future, mins_in_past=for_compute_default_mins_in_past):
-        slope = self.get_slope_inner(mins_in_past=mins_in_past)
-        y_curr = self.data[0].reading_now
-        y_next = y_curr + slope * mins_in_future
-        return int(y_next)
+        ts_min, readings, present_idx = self._projection_arrays
+        return int(project(ts_min, readings, mins_in_future, ref_idx=present_idx, windows=[mins_in_past])[0])
 
     def get_avg_projected_val_inner(self, mins_in_future):
-        vals = []
-        for mins_in_past in range(5, DEFAULT_MINS_IN_PAST + 1):
-            vals.append(
-                self.get_projected_val_inner(
-                    mins_in_future=mins_in_future,
-                    mins_in_past=mins_in_past
-                )
-            )
-        return int(np.mean(vals))
+        ts_min, readings, present_idx = self._projection_arrays
+        return int(project(ts_min, readings, mins_in_future, ref_idx=present_idx)[0])
+
+    def get_estimated_val_inner(self, mins_in_future):
+        ts_min, _, present_idx = self._projection_arrays
+        estimator = self.estimator
+        if estimator is None or estimator.latest_ts != ts_min[present_idx[0]]:
+            estimator = StreamingTrendEstimator.from_columns(self.columns, window_mins=self.for_compute_default_mins_in_past)
+        return estimator.projected(mins_in_future=mins_in_future)
 
     def log_projections(self):
         v0t, v0v = self.present_timestamp, self.present_reading
@@ -132,20 +212,16 @@ class DataProcessor:
 
         v30 = self.get_projected_val_inner(mins_in_future=30)
         av30 = self.get_avg_projected_val_inner(mins_in_future=30)
-        print(f"{v0t} = {v0v}, V20={v20}/{av20}, V30={v30}/{av30}")
+        e20 = self.get_estimated_val_inner(mins_in_future=20)
+        print(f"{v0t} = {v0v}, V20={v20}/{av20}/{e20}, V30={v30}/{av30}")
 
     def get_time_out_of_range(self):
-        time_oor = 0
-        curr_t = self.present_timestamp
-        curr_val = self.present_reading
-        if is_out_of_range(curr_val, value_type=VAL_CURRENT):
-            for idel in self.data:
-                if is_out_of_range(idel.reading_now, value_type=VAL_CURRENT):
-                    continue
-                else:
-                    time_oor = (curr_t - idel.timestamp).seconds // 60
-                    break
-        return time_oor
+        """Minutes since the last in range reading, 0 when the present reading is in range."""
+        out_of_range = out_of_range_mask(self.columns.reading_now, value_type=VAL_CURRENT)
+        in_range_idx = np.flatnonzero(~out_of_range)
+        if not out_of_range[-1] or not len(in_range_idx):
+            return 0
+        return int((self.columns.timestamp[-1] - self.columns.timestamp[in_range_idx[-1]]) // np.timedelta64(1, "m"))
 
 def get_last(data: List[Union[IglooDataElement, IglooUpdatesElement]], minutes: int) -> List[Union[IglooDataElement, IglooUpdatesElement]]:
     if not data:
@@ -0,0 +1,65 @@
+"""
+Projected readings from the slopes over the last 5 to 15 minutes, averaged over the window lengths.
+Everything works on whole reading arrays, so any number of reference readings is projected in one pass.
+Shared by the populator, the notifier (through DataProcessor) and historical recomputes.
+"""
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from datastore.columnar import ReadingColumns
+
+DEFAULT_MINS_IN_PAST = 15
+DEFAULT_MINS_IN_FUTURE = 20
+MIN_MINS_IN_PAST = 5
+PROJECTION_WINDOWS = np.arange(MIN_MINS_IN_PAST, DEFAULT_MINS_IN_PAST + 1)
+
+
+def as_minutes(timestamps) -> np.ndarray:
+    """Epoch minutes, from either stored integers or datetime64[m] columns."""
+    return np.asarray(timestamps).astype(np.int64)
+
+
+def window_slopes(ts_min: np.ndarray, readings: np.ndarray, ref_idx: np.ndarray,
+                  windows: Sequence[int] = PROJECTION_WINDOWS) -> np.ndarray:
+    """
+    Slope of every window ending at every reference reading, shaped (len(ref_idx), len(windows)).
+    A window starts at its oldest reading no more than `window` minutes back, and the difference
+    is divided by the window length rather than the actual gap.
+    """
+    ref_idx, windows = np.asarray(ref_idx), np.asarray(windows)
+    window_starts = np.searchsorted(ts_min, ts_min[ref_idx][:, None] - windows, side="left")
+    return (readings[ref_idx][:, None] - readings[window_starts]) / windows
+
+
+def project(ts_min: np.ndarray, readings: np.ndarray, mins_in_future: int, ref_idx: Optional[np.ndarray] = None,
+            windows: Sequence[int] = PROJECTION_WINDOWS) -> np.ndarray:
+    """Projection `mins_in_future` ahead of each reference reading, each window's value truncated before averaging."""
+    ref_idx = np.arange(len(ts_min)) if ref_idx is None else np.asarray(ref_idx)
+    slopes = window_slopes(ts_min, readings, ref_idx, windows=windows)
+    per_window = np.trunc(readings[ref_idx][:, None] + slopes * mins_in_future)
+    return np.trunc(per_window.mean(axis=1)).astype(np.int64)
+
+
+def project_with_velocity(ts_min: np.ndarray, readings: np.ndarray, mins_in_future: int = DEFAULT_MINS_IN_FUTURE,
+                          ref_idx: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """(reading_20, velocity) for each reference reading, velocity being the projected change per minute."""
+    ref_idx = np.arange(len(ts_min)) if ref_idx is None else np.asarray(ref_idx)
+    projected = project(ts_min, readings, mins_in_future, ref_idx=ref_idx)
+    return projected, (projected - readings[ref_idx]) / mins_in_future
+
+
+def project_columns(columns: ReadingColumns, ref_ts: Optional[Sequence[int]] = None,
+                    mins_in_future: int = DEFAULT_MINS_IN_FUTURE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    project_with_velocity over fetched columns, for the readings at `ref_ts` (epoch minutes) or all of them.
+    The columns must reach DEFAULT_MINS_IN_PAST back from the first reference reading.
+    """
+    ts_min = as_minutes(columns.timestamp)
+    ref_idx = None
+    if ref_ts is not None:
+        ref_ts = np.asarray(ref_ts, dtype=np.int64)
+        ref_idx = np.searchsorted(ts_min, ref_ts)
+        if np.any(ref_idx >= len(ts_min)) or np.any(ts_min[np.minimum(ref_idx, len(ts_min) - 1)] != ref_ts):
+            raise ValueError("Reference timestamps must all be present in the columns")
+    return project_with_velocity(ts_min, columns.reading_now, mins_in_future=mins_in_future, ref_idx=ref_idx)
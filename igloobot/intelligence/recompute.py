@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+
+from config.utils import to_epoch_minutes, PROJECTION_METHOD, PROJECTION_STREAMING
+from datastore.primitives import SqliteDatabase
+from intelligence.estimator import project_columns_streaming
+from intelligence.projection import DEFAULT_MINS_IN_PAST, as_minutes, project_columns
+
+RECOMPUTE_CHUNK_DAYS = 7
+
+
+def recompute_projections(sqldb: SqliteDatabase, ts_start: Optional[datetime] = None, ts_end: Optional[datetime] = None,
+                          chunk_days: int = RECOMPUTE_CHUNK_DAYS, projection_method: str = PROJECTION_METHOD) -> int:
+    """
+    Recomputes reading_20 and velocity of every reading in [ts_start, ts_end] with the current projection logic,
+    the same `projection_method` the populator projects new readings with.
+    igloo_data is walked in chunks of `chunk_days`, each read with enough history for its first projections,
+    projected in one pass and written back in its own short transaction. Returns the rows changed.
+    """
+    ts_start = ts_start or sqldb.main_table.fetch_earliest_timestamp()
+    ts_end = ts_end or sqldb.main_table.fetch_latest_timestamp()
+    if ts_start is None or ts_end is None:
+        return 0
+
+    project = project_columns_streaming if projection_method == PROJECTION_STREAMING else project_columns
+    history = timedelta(minutes=DEFAULT_MINS_IN_PAST)
+    chunk_start, total_changed = ts_start, 0
+    while chunk_start <= ts_end:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days) - timedelta(minutes=1), ts_end)
+        with sqldb.transaction():
+            columns = sqldb.main_table.fetch_columns(ts_start=chunk_start - history, ts_end=chunk_end)
+            ts_min = as_minutes(columns.timestamp)
+            in_chunk = ts_min >= to_epoch_minutes(chunk_start)
+            if in_chunk.any():
+                reading_20, velocity = project(columns, ref_ts=ts_min[in_chunk])
+                # only rows whose values actually move get written
+                changed = (reading_20 != columns.reading_20[in_chunk]) | (velocity != columns.velocity[in_chunk])
+                if changed.any():
+                    sqldb.main_table.update_computed_columns(
+                        ts_min[in_chunk][changed], reading_20[changed].astype(np.float64), velocity[changed]
+                    )
+                total_changed += int(changed.sum())
+        print(f"Recomputed {chunk_start} to {chunk_end}, {total_changed} rows changed so far")
+        chunk_start = chunk_end + timedelta(minutes=1)
+    return total_changed
@@ -1,29 +1,16 @@
-import datetime
-
-from datastore.primitives import SqliteDatabase, IglooUpdatesElement, ElementNotFoundException
+from datastore.primitives import get_database, IglooUpdatesElement, IglooInsulinEvent
 
 MINS = 60
 POLL_INTERVAL = 1 * MINS
 
 
 def record_insu(event_ts, ins_val: int):
-    # we update values of current insulin in the system
-    sqldb = SqliteDatabase()
-    for min_from_now in range(120):
-        ins_added_note = f"{ins_val}u-added" if min_from_now == 0 else ""
-        ts_to_process = event_ts + datetime.timedelta(minutes=min_from_now)
-        try:
-            curr_el = sqldb.updates_table.fetch_w_ts(ts_to_process)
-            curr_ins_val = curr_el.ins_units
-        except ElementNotFoundException:
-            curr_ins_val = 0
-
-        new_el = IglooUpdatesElement(
-            timestamp=ts_to_process,
-            ins_units=curr_ins_val + ins_val,
-            misc_note=ins_added_note
-        )
-        push_event(updates_ele=new_el)
+    # one event per dose, insulin on board is worked out from it while reading
+    sqldb = get_database()
+    # the dose and its timeline note are stored together or not at all
+    with sqldb.transaction():
+        sqldb.insulin_table.insert(IglooInsulinEvent(timestamp=event_ts, units=ins_val))
+        push_event(updates_ele=IglooUpdatesElement(timestamp=event_ts, misc_note=f"{ins_val}u-added"))
 
 def record_food(event_ts, food_text: str):
     el = IglooUpdatesElement(timestamp=event_ts, food_note=food_text)
@@ -34,6 +21,6 @@ def record_misc(event_ts, misc_text: str):
     push_event(updates_ele=el)
 
 def push_event(updates_ele: IglooUpdatesElement):
-    sqldb = SqliteDatabase()
+    sqldb = get_database()
     sqldb.updates_table.update_(updates_ele)
     print(f"--------")
@@ -0,0 +1,94 @@
+"""
+Rendering itself stays in memory, plots are encoded to bytes and sent without a temporary file. The one place they
+touch the disk is this cache: the notifier, jarvis and their render workers are separate processes, and a
+directory is the simplest store they all share. A hit costs a single small file read, far below a render.
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+from config.utils import PLOT_CACHE_DIR, PLOT_CACHE_MAX_ENTRIES
+from datastore.primitives import SqliteDatabase
+from intelligence.insulin import MAX_INSULIN_ACTION_MINS
+
+# part of every key, bump it when a change to the plotting code should not be served from old renders
+RENDER_CACHE_VERSION = 1
+CACHE_SUFFIX = ".img"
+
+
+def window_version(sqldb: SqliteDatabase, ts_start: datetime, ts_end: datetime, readings_only: bool = False) -> Tuple:
+    """What a plot of [ts_start, ts_end] is drawn from, changes whenever any of it is written."""
+    version = sqldb.main_table.fetch_version(ts_start, ts_end)
+    if readings_only:
+        return version
+    # doses from before the window are still drawn as insulin on board
+    return version + sqldb.updates_table.fetch_version(ts_start, ts_end) + sqldb.insulin_table.fetch_version(
+        ts_start - timedelta(minutes=MAX_INSULIN_ACTION_MINS), ts_end
+    )
+
+
+class RenderCache:
+    """
+    Rendered plots on disk, keyed by the window, config and data version they were drawn from. On disk so a plot
+    rendered by any worker, pre-rendered ones included, is served to every bot. Least recently used entries go past
+    `max_entries`.
+    """
+    def __init__(self, cache_dir: str = PLOT_CACHE_DIR, max_entries: int = PLOT_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha1(repr((RENDER_CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as image_file:
+                image = image_file.read()
+            # mtime is the last use, for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return image
+
+    def put(self, key: str, image: bytes):
+        # written aside and renamed in, readers in other processes only ever see whole images
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as image_file:
+            image_file.write(image)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        for _, path in sorted(entries)[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_or_render(self, key: str, render: Callable[[], Optional[bytes]]) -> Optional[bytes]:
+        image = self.get(key)
+        if image is None:
+            image = render()
+            if image is not None:
+                self.put(key, image)
+        return image
+
+
+@lru_cache(maxsize=None)
+def get_render_cache(cache_dir: str = PLOT_CACHE_DIR) -> RenderCache:
+    return RenderCache(cache_dir=cache_dir)
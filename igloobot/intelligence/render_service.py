@@ -0,0 +1,127 @@
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Callable, Optional
+
+from config.utils import RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_DELIVERY_THREADS
+
+# jobs are sent by name, so only the workers ever import matplotlib
+RENDER_JOBS = ("plot_default", "plot_specific", "plot_agp", "plot_range", "prerender_default_plot")
+
+
+class RenderQueueFull(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def _init_worker():
+    # paid once per worker at start up instead of on the first plot somebody waits for
+    from datastore.primitives import get_database
+    import intelligence.plotting_utils  # noqa: F401
+    get_database()
+
+
+def _render(job: str, kwargs: dict) -> Optional[bytes]:
+    from intelligence import plotting_utils
+    return getattr(plotting_utils, job)(**kwargs)
+
+
+def _ready() -> bool:
+    return True
+
+
+def _run_delivery(deliver: Callable[[Future], None], future: Future):
+    try:
+        deliver(future)
+    except Exception as exc:
+        print(f"Plot delivery failed. Exception = {exc}")
+
+
+class RenderService:
+    """
+    Plots rendered in a small pool of worker processes, so the bots never wait on matplotlib or the GIL for them.
+    At most `queue_size` renders are pending at a time, past that `submit` raises RenderQueueFull.
+    """
+    def __init__(self, workers: int = RENDER_WORKERS, queue_size: int = RENDER_QUEUE_SIZE,
+                 delivery_threads: int = RENDER_DELIVERY_THREADS):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = self._new_executor()
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._deliveries = ThreadPoolExecutor(max_workers=delivery_threads, thread_name_prefix="render-delivery")
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawned, not forked, the bots hold sqlite connections and threads that must not be copied into workers
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker)
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        """A worker died (OOM, a crash in a C extension) and took the pool down with it, starts a fresh one."""
+        with self._executor_lock:
+            if self.executor is not broken:
+                # another thread already replaced it
+                return
+            print("Render pool is broken, starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._new_executor()
+
+    def warm(self):
+        """Starts every worker now, instead of on the first submit."""
+        for future in [self.executor.submit(_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, job: str, **kwargs) -> Future:
+        """Renders `job` of plotting_utils with `kwargs` in a worker, the future's result is the image bytes or None."""
+        if job not in RENDER_JOBS:
+            raise ValueError(f"Unknown render job {job}")
+        if not self._slots.acquire(blocking=False):
+            raise RenderQueueFull(f"{self.queue_size} renders already pending")
+        try:
+            executor = self.executor
+            try:
+                future = executor.submit(_render, job, kwargs)
+            except BrokenProcessPool:
+                # renders in flight when the worker died fail with the pool, this one is retried once on a new pool
+                self._replace_executor(executor)
+                future = self.executor.submit(_render, job, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def deliver(self, future: Future, deliver: Callable[[Future], None]):
+        """
+        Calls `deliver(future)` on a delivery thread once the render is done. Done callbacks run on the pool's
+        result thread, so a slow telegram send made from one would hold up the results of every other render.
+        """
+        future.add_done_callback(lambda done: self._deliveries.submit(_run_delivery, deliver, done))
+
+    def plot_default(self, **kwargs) -> Future:
+        return self.submit("plot_default", **kwargs)
+
+    def plot_specific(self, **kwargs) -> Future:
+        return self.submit("plot_specific", **kwargs)
+
+    def plot_agp(self, **kwargs) -> Future:
+        return self.submit("plot_agp", **kwargs)
+
+    def plot_range(self, **kwargs) -> Future:
+        return self.submit("plot_range", **kwargs)
+
+    def prerender_default_plot(self) -> Future:
+        return self.submit("prerender_default_plot")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self._deliveries.shutdown(wait=False, cancel_futures=True)
+
+
+@lru_cache(maxsize=None)
+def get_render_service() -> RenderService:
+    """Process wide RenderService."""
+    return RenderService()
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+
+from config.utils import to_epoch_minutes, from_epoch_minutes
+from datastore.columnar import ReadingColumns, decode_timestamps
+from datastore.primitives import SqliteDatabase
+
+RING_BUFFER_HOURS = 12
+# rows this far behind the newest reading are re-read on refresh, to pick up late computed values
+REFRESH_OVERLAP_MINS = 30
+
+
+class ReadingsRingBuffer:
+    """
+    Fixed size, array backed copy of the most recent readings (one slot per minute).
+    Loaded once from sqlite and then appended to, so the recent window can be served without touching the db.
+    """
+    def __init__(self, hours: int = RING_BUFFER_HOURS):
+        self.capacity = hours * 60
+        self._ts = np.zeros(self.capacity, dtype=np.int64)
+        self._reading_now = np.zeros(self.capacity, dtype=np.int64)
+        self._reading_20 = np.zeros(self.capacity, dtype=np.float64)
+        self._velocity = np.zeros(self.capacity, dtype=np.float64)
+        self._start = 0
+        self._size = 0
+        # earliest minute the buffer holds everything for, None until loaded
+        self.window_start: Optional[int] = None
+        self._data_version = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def latest_ts(self) -> Optional[int]:
+        return int(self._ts[(self._start + self._size - 1) % self.capacity]) if self._size else None
+
+    @classmethod
+    def load(cls, sqldb: SqliteDatabase, until: datetime, hours: int = RING_BUFFER_HOURS) -> "ReadingsRingBuffer":
+        buffer = cls(hours=hours)
+        buffer._data_version = buffer._current_data_version(sqldb)
+        ts_start = until - timedelta(hours=hours)
+        buffer._extend(sqldb.main_table.fetch_columns(ts_start=ts_start, ts_end=until))
+        buffer.window_start = to_epoch_minutes(ts_start) if buffer._size < buffer.capacity else buffer._oldest_ts()
+        return buffer
+
+    def _oldest_ts(self) -> int:
+        return int(self._ts[self._start])
+
+    def _order(self) -> np.ndarray:
+        return (self._start + np.arange(self._size)) % self.capacity
+
+    def _extend(self, columns: ReadingColumns):
+        ts_values = columns.timestamp.astype(np.int64)
+        for idx in range(len(ts_values)):
+            self.append(int(ts_values[idx]), int(columns.reading_now[idx]),
+                        float(columns.reading_20[idx]), float(columns.velocity[idx]))
+
+    def append(self, ts: int, reading_now: int, reading_20: float = 0, velocity: float = 0.0):
+        """Adds a reading keyed on epoch minutes, readings at or before the latest one are merged in place."""
+        if self._size and ts <= self.latest_ts:
+            self._merge(ts, reading_now, reading_20, velocity)
+            return
+
+        slot = (self._start + self._size) % self.capacity
+        self._ts[slot], self._reading_now[slot] = ts, reading_now
+        self._reading_20[slot], self._velocity[slot] = reading_20, velocity
+        if self._size == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+            self.window_start = self._oldest_ts()
+        else:
+            self._size += 1
+
+    def _merge(self, ts: int, reading_now: int, reading_20: float, velocity: float):
+        order = self._order()
+        ordered_ts = self._ts[order]
+        pos = int(np.searchsorted(ordered_ts, ts))
+        if pos < self._size and ordered_ts[pos] == ts:
+            slot = order[pos]
+            self._reading_now[slot], self._reading_20[slot], self._velocity[slot] = reading_now, reading_20, velocity
+            return
+        if self.window_start is not None and ts < self.window_start:
+            return
+
+        # late reading in the middle of the buffer, rare enough to just rebuild the arrays in order
+        columns = [np.insert(arr[order], pos, val) for arr, val in (
+            (self._ts, ts), (self._reading_now, reading_now), (self._reading_20, reading_20), (self._velocity, velocity)
+        )]
+        keep = slice(max(0, len(columns[0]) - self.capacity), None)
+        self._size = len(columns[0][keep])
+        self._start = 0
+        for arr, col in zip((self._ts, self._reading_now, self._reading_20, self._velocity), columns):
+            arr[:self._size] = col[keep]
+        if keep.start:
+            self.window_start = self._oldest_ts()
+
+    def update_computed_vals(self, ts: int, reading_20: float, velocity: float):
+        order = self._order()
+        pos = int(np.searchsorted(self._ts[order], ts))
+        if pos < self._size and self._ts[order[pos]] == ts:
+            self._reading_20[order[pos]], self._velocity[order[pos]] = reading_20, velocity
+
+    def covers(self, ts_start: datetime) -> bool:
+        return self.window_start is not None and to_epoch_minutes(ts_start) >= self.window_start
+
+    def columns(self, ts_start: datetime, ts_end: datetime) -> ReadingColumns:
+        order = self._order()
+        lo = np.searchsorted(self._ts[order], to_epoch_minutes(ts_start), side="left")
+        hi = np.searchsorted(self._ts[order], to_epoch_minutes(ts_end), side="right")
+        window = order[lo:hi]
+        return ReadingColumns(
+            timestamp=decode_timestamps(self._ts[window]),
+            reading_now=self._reading_now[window].copy(),
+            reading_20=self._reading_20[window].copy(),
+            velocity=self._velocity[window].copy(),
+        )
+
+    @staticmethod
+    def _current_data_version(sqldb: SqliteDatabase) -> int:
+        return sqldb.execute_query("PRAGMA data_version;").fetchone()[0]
+
+    def refresh(self, sqldb: SqliteDatabase) -> bool:
+        """
+        Pulls in rows other processes committed since the last refresh.
+        PRAGMA data_version only changes when another connection commits, so an idle tick reads no rows.
+        """
+        data_version = self._current_data_version(sqldb)
+        if self.window_start is None or data_version == self._data_version:
+            return False
+        self._data_version = data_version
+
+        latest_ts = self.latest_ts if self._size else self.window_start
+        since = from_epoch_minutes(latest_ts - REFRESH_OVERLAP_MINS)
+        self._extend(sqldb.main_table.fetch_columns(ts_start=since, ts_end=datetime.max))
+        return True
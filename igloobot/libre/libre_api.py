@@ -1,8 +1,11 @@
 from datetime import datetime
+from functools import lru_cache
 import hashlib
 
 import requests
-from typing import Dict
+from requests.adapters import HTTPAdapter
+from typing import Dict, Optional
+from urllib3.util.retry import Retry
 
 # Constants
 BASE_URL = "https://api-us.libreview.io"  # Changed to US-specific endpoint
@@ -15,6 +18,29 @@ HEADERS = {
     'version': '4.16.0',
     'account-id': ''
 }
+REQUEST_TIMEOUT_SECS = 30
+
+
+def create_session() -> requests.Session:
+    """
+    Keep-alive session, so polls reuse one TLS connection instead of handshaking every minute.
+    Transient failures (throttling, 5xx, dropped connections) are retried with exponential backoff.
+    """
+    retry = Retry(
+        total=4,
+        backoff_factor=2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retry))
+    session.headers.update(HEADERS)
+    return session
+
+
+SESSION = create_session()
+LIBRE_TIMESTAMP_FORMAT = '%m/%d/%Y %I:%M:%S %p'
 
 
 # Function to log in and retrieve JWT token
@@ -25,7 +51,7 @@ def login(email, password):
         "password": password
     }
 
-    response = requests.post(BASE_URL + endpoint, headers=HEADERS, json=payload)
+    response = SESSION.post(BASE_URL + endpoint, json=payload, timeout=REQUEST_TIMEOUT_SECS)
     response.raise_for_status()
     data = response.json()
 
@@ -36,7 +62,7 @@ def login(email, password):
 
         # Complete TOU using the correct endpoint from documentation
         tou_headers = {**HEADERS, 'Authorization': f'Bearer {tou_token}'}
-        tou_response = requests.post(BASE_URL + "/auth/continue/tou", headers=tou_headers)
+        tou_response = SESSION.post(BASE_URL + "/auth/continue/tou", headers=tou_headers, timeout=REQUEST_TIMEOUT_SECS)
 
         if tou_response.status_code == 200:
             tou_data = tou_response.json()
@@ -62,7 +88,7 @@ def get_patient_connections(token, account_id):
     endpoint = "/llu/connections"  # This is a placeholder, you'll need to replace with the actual endpoint
     headers = {**HEADERS, 'Authorization': f"Bearer {token}", 'account-id': hashlib.sha256(account_id.encode()).hexdigest()}
 
-    response = requests.get(BASE_URL + endpoint, headers=headers)
+    response = SESSION.get(BASE_URL + endpoint, headers=headers, timeout=REQUEST_TIMEOUT_SECS)
     response.raise_for_status()
     return response.json()
 
@@ -72,14 +98,30 @@ def get_cgm_data(token, patient_id, account_id):
     endpoint = f"/llu/connections/{patient_id}/graph"  # This is a placeholder, replace with the actual endpoint
     headers = {**HEADERS, 'Authorization': f"Bearer {token}", 'account-id': hashlib.sha256(account_id.encode()).hexdigest()}
 
-    response = requests.get(BASE_URL + endpoint, headers=headers)
+    response = SESSION.get(BASE_URL + endpoint, headers=headers, timeout=REQUEST_TIMEOUT_SECS)
     response.raise_for_status()
     return response.json()
 
 
+@lru_cache(maxsize=2048)
+def parse_libre_timestamp(ts_str: str) -> datetime:
+    """
+    Hand rolled parser for the fixed '3/9/2025 9:30:58 PM' format, much cheaper than strptime.
+    Cached, since consecutive polls return mostly the same graphData timestamps.
+    """
+    try:
+        date_part, time_part, meridiem = ts_str.split(" ")
+        month, day, year = date_part.split("/")
+        hour, minute, second = time_part.split(":")
+        hour = int(hour) % 12 + (12 if meridiem.upper() == "PM" else 0)
+        return datetime(int(year), int(month), int(day), hour, int(minute), int(second))
+    except ValueError:
+        return datetime.strptime(ts_str, LIBRE_TIMESTAMP_FORMAT)
+
+
 def extract_latest_reading(_response) -> Dict[datetime, int]:
     item = _response['data']['connection']['glucoseItem']
-    ts = datetime.strptime(item['Timestamp'], '%m/%d/%Y %I:%M:%S %p')
+    ts = parse_libre_timestamp(item['Timestamp'])
     val = item['ValueInMgPerDl']
     return {ts: val}
 
@@ -88,7 +130,26 @@ def extract_previous_readings(_response) -> Dict[datetime, int]:
     all_data = _response['data']['graphData']
     _graphdata_map = {}
     for item in all_data:
-        ts = datetime.strptime(item['Timestamp'], '%m/%d/%Y %I:%M:%S %p')
+        ts = parse_libre_timestamp(item['Timestamp'])
         val = item['ValueInMgPerDl']
         _graphdata_map[ts] = val
     return _graphdata_map
+
+
+def _is_after(ts: datetime, watermark: Optional[datetime]) -> bool:
+    # stored readings are minute resolution
+    return watermark is None or ts.replace(second=0, microsecond=0) > watermark
+
+
+def extract_readings_since(_response, watermark: Optional[datetime]) -> Dict[datetime, int]:
+    """
+    Readings newer than watermark, from the latest reading and graphData.
+    graphData is chronological, so it is walked from the end and parsing stops at the watermark.
+    """
+    readings = {ts: val for ts, val in extract_latest_reading(_response).items() if _is_after(ts, watermark)}
+    for item in reversed(_response['data']['graphData']):
+        ts = parse_libre_timestamp(item['Timestamp'])
+        if not _is_after(ts, watermark):
+            break
+        readings[ts] = item['ValueInMgPerDl']
+    return readings
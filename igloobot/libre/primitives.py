@@ -1,54 +1,105 @@
+import json
+import os
 import time
 from dataclasses import dataclass, field
 from datetime import datetime
 from functools import cached_property
-from typing import Dict
+from typing import Dict, Optional
+
+import requests
 
 from config.constants import LIBRE_EMAIL, LIBRE_PWD
+from config.utils import LIBRE_TOKEN_CACHE_PATH
 from libre.libre_api import extract_latest_reading
-from libre.libre_api import login, get_patient_connections, get_cgm_data, extract_previous_readings
+from libre.libre_api import login, get_patient_connections, get_cgm_data, extract_readings_since
+
+
+# a cached ticket this close to expiry is not worth starting with
+TOKEN_EXPIRY_MARGIN_SECS = 5 * 60
+CACHED_FIELDS = ("token", "expires", "account_id", "patient_id")
 
 
 class LibreToken:
-    def __init__(self):
+    def __init__(self, cache_path=LIBRE_TOKEN_CACHE_PATH):
+        self.cache_path = cache_path
+        self.token, self.expires, self.account_id, self.patient_id = None, None, None, None
+        if not self._load_cache():
+            self.login()
+
+    def login(self):
         self.token, self.expires, self.account_id = login(LIBRE_EMAIL, LIBRE_PWD)
         self.patient_id = get_patient_connections(self.token, self.account_id)['data'][0]["patientId"]
+        self._save_cache()
 
     def refresh(self):
         if self.expires and time.time() >= self.expires:
             print("Token expired, refreshing.")
             self.token, self.expires, self.account_id = login(LIBRE_EMAIL, LIBRE_PWD)
+            self._save_cache()
+
+    def _load_cache(self) -> bool:
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return False
+        if any(not cached.get(key) for key in CACHED_FIELDS):
+            return False
+        if cached["expires"] <= time.time() + TOKEN_EXPIRY_MARGIN_SECS:
+            print("Cached token expired, logging in.")
+            return False
+        self.token, self.expires, self.account_id, self.patient_id = (cached[key] for key in CACHED_FIELDS)
+        print("Using cached token.")
+        return True
+
+    def _save_cache(self):
+        # the ticket is a bearer credential, keep it readable by the owner only
+        tmp_path = f"{self.cache_path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump({key: getattr(self, key) for key in CACHED_FIELDS}, cache_file)
+        os.replace(tmp_path, self.cache_path)
+
+    def invalidate(self):
+        self.expires = 0
+        if os.path.exists(self.cache_path):
+            os.unlink(self.cache_path)
 
 
 @dataclass
 class LibreManager:
-    curr_response: Dict[datetime, int] = field(default_factory=dict)
-    prev_response: Dict[datetime, int] = field(default_factory=dict)
+    # newest reading already in the datastore, only readings after it are picked up
+    watermark: Optional[datetime] = None
+    new_readings: Dict[datetime, int] = field(default_factory=dict)
 
     @cached_property
     def libre_token(self) -> LibreToken:
         return LibreToken()
 
-    @property
-    def new_readings(self) -> Dict[datetime, int]:
-        return {k: v for k, v in self.curr_response.items() if k not in self.prev_response}
+    def advance_watermark(self, stored_readings: Dict[datetime, int]):
+        if stored_readings:
+            latest = max(stored_readings).replace(second=0, microsecond=0)
+            self.watermark = max(self.watermark, latest) if self.watermark else latest
 
     def get_full_cgm_response(self):
         self.libre_token.refresh()
-        cgm_data = get_cgm_data(token=self.libre_token.token, patient_id=self.libre_token.patient_id, account_id=self.libre_token.account_id)
+        try:
+            cgm_data = get_cgm_data(token=self.libre_token.token, patient_id=self.libre_token.patient_id, account_id=self.libre_token.account_id)
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code != 401:
+                raise
+            # ticket revoked before its expiry (e.g. logged in elsewhere), log in again once
+            print("Token rejected, logging in again.")
+            self.libre_token.invalidate()
+            self.libre_token.login()
+            cgm_data = get_cgm_data(token=self.libre_token.token, patient_id=self.libre_token.patient_id, account_id=self.libre_token.account_id)
         self.libre_token.expires = cgm_data['ticket']['expires']
         return cgm_data
 
     def update_data_state(self):
         cgm_response = self.get_full_cgm_response()
         latest_reading = extract_latest_reading(cgm_response)
-        previous_readings = extract_previous_readings(cgm_response)
-
-        self.prev_response = self.curr_response.copy()
-
-        self.curr_response.clear()
-        self.curr_response.update(latest_reading)
-        self.curr_response.update(previous_readings)
+        self.new_readings = extract_readings_since(cgm_response, self.watermark)
 
         _curr_time = next(iter(latest_reading))
         _latest_val = latest_reading[_curr_time]
@@ -1,21 +1,93 @@
 import argparse
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+# what each option imports, only the chosen one is loaded
+ENTRY_MODULES = {
+    "populator": "automatons.populator",
+    "notifier": "automatons.notifier",
+    "jarvis": "automatons.jarvis",
+    "migrate": "datastore.primitives",
+    "recompute": "intelligence.recompute",
+    "rebuild_rollups": "datastore.primitives",
+    "backfill_meal_responses": "intelligence.meals",
+}
+PROFILE_TOP_MODULES = 25
+
+
+def profile_startup(entry_module: str, top: int = PROFILE_TOP_MODULES):
+    """Imports `entry_module` in a fresh interpreter and prints the modules that took longest to import."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {entry_module}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode:
+        print(result.stderr)
+        return
+    timings = []
+    # lines are "import time: self [us] | cumulative | imported package", nested imports indented
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        timings.append((int(cumulative_us), int(self_us), module.strip()))
+    total_us = next(cumulative_us for cumulative_us, _, module in timings if module == entry_module)
+    print(f"{entry_module} imports in {total_us / 1000:.1f} ms, {len(timings)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for cumulative_us, self_us, module in sorted(timings, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {module}")
 
-from automatons import notifier
-from automatons import populator
-from automatons import jarvis
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage='run.py [options]')
     parser.add_argument("--populator", action="store_true", help="run populator")
     parser.add_argument("--notifier", action="store_true", help="run notifier")
     parser.add_argument("--jarvis", action="store_true", help="run jarvis")
+    parser.add_argument("--migrate", action="store_true",
+                        help="bring the database up to the latest schema, safe to run while the populator is up")
+    parser.add_argument("--recompute", action="store_true",
+                        help="recompute reading_20 and velocity over history with the current projection logic")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="rebuild the 5 min, hourly and daily rollups from the readings")
+    parser.add_argument("--backfill-meal-responses", action="store_true",
+                        help="compute the responses of every logged meal the populator has not, e.g. after upgrading")
+    parser.add_argument("--from", dest="ts_from", type=datetime.fromisoformat, default=None,
+                        help="with --recompute, --rebuild-rollups or --backfill-meal-responses, first timestamp to "
+                             "cover, e.g. '2025-03-01 00:00'")
+    parser.add_argument("--to", dest="ts_to", type=datetime.fromisoformat, default=None,
+                        help="with --recompute, --rebuild-rollups or --backfill-meal-responses, last timestamp to cover")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="with any other option, report per module import times of it instead of running it, "
+                             "of every entry point without one")
     args = parser.parse_args()
-    
-    if args.populator:
+
+    if args.profile_startup:
+        chosen = [option for option in ENTRY_MODULES if getattr(args, option)]
+        for entry_module in dict.fromkeys(ENTRY_MODULES[option] for option in chosen or ENTRY_MODULES):
+            profile_startup(entry_module)
+    elif args.populator:
+        from automatons import populator
         populator.run()
     elif args.notifier:
+        from automatons import notifier
         notifier.run()
     elif args.jarvis:
+        from automatons import jarvis
         jarvis.poll()
+    elif args.migrate:
+        from datastore.primitives import get_database
+        get_database()
+    elif args.recompute:
+        from datastore.primitives import get_database
+        from intelligence.recompute import recompute_projections
+        recompute_projections(get_database(), ts_start=args.ts_from, ts_end=args.ts_to)
+    elif args.rebuild_rollups:
+        from datastore.primitives import get_database
+        get_database().rollups_table.rebuild(ts_start=args.ts_from, ts_end=args.ts_to)
+    elif args.backfill_meal_responses:
+        from datastore.primitives import get_database
+        from intelligence.meals import backfill_meal_responses
+        backfill_meal_responses(get_database(), ts_start=args.ts_from, ts_end=args.ts_to)
     else:
         parser.print_help()
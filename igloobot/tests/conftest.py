@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app imports its packages from igloobot/, the way run.py is started
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from config.utils import GLU_RANGES, L_RANGE, IN_RANGE, H_RANGE, VH_RANGE, VL_RANGE, VAL_CURRENT, VAL_PROJECTED, \
+    GLU_VERY_LOW, GLU_LOW, GLU_IN_RANGE, GLU_HIGH, GLU_VERY_HIGH, classify_glu_ranges, range_percentages, \
+    excursion_runs, out_of_range_mask, get_glu_range_id, is_out_of_range, is_high, is_very_high, is_low, is_very_low
+
+BOUNDARIES = [-120, 0, 69, 70, 89, 90, 149, 150, 199, 200, 499]
+
+
+# the scalar helpers as they were before classification was vectorized, membership in the arange()s
+def legacy_glu_range_id(value):
+    for range_id, glu_range in GLU_RANGES.items():
+        if value in glu_range:
+            return range_id
+
+
+def legacy_is_out_of_range(value, value_type):
+    if value_type == VAL_PROJECTED:
+        return value not in np.hstack((L_RANGE, IN_RANGE, H_RANGE))
+    return value not in IN_RANGE
+
+
+@pytest.mark.parametrize("value", BOUNDARIES)
+def test_boundaries_match_the_legacy_helpers(value):
+    assert get_glu_range_id(value) == legacy_glu_range_id(value)
+    assert is_high(value) == (value in H_RANGE or value in VH_RANGE)
+    assert is_very_high(value) == (value in VH_RANGE)
+    assert is_low(value) == (value in L_RANGE)
+    assert is_very_low(value) == (value in VL_RANGE)
+    for value_type in (VAL_CURRENT, VAL_PROJECTED):
+        assert is_out_of_range(value, value_type) == legacy_is_out_of_range(value, value_type)
+
+
+def test_every_integer_reading_matches_the_legacy_helpers():
+    values = np.arange(-120, 500)
+    assert classify_glu_ranges(values).tolist() == [legacy_glu_range_id(int(v)) for v in values]
+
+
+def test_readings_of_500_and_above_are_very_high():
+    # the legacy helpers left them unclassified, so a sensor "HI" reading was not even high
+    assert legacy_glu_range_id(500) is None
+    assert classify_glu_ranges([500, 501, 600]).tolist() == [GLU_VERY_HIGH] * 3
+    assert is_high(500) and is_very_high(500)
+    assert is_out_of_range(500, VAL_PROJECTED) and is_out_of_range(500, VAL_CURRENT)
+
+
+def test_fractional_values_fall_in_the_range_containing_them():
+    # the legacy helpers never matched a fractional value against the integer ranges
+    assert legacy_glu_range_id(89.5) is None
+    assert classify_glu_ranges([69.9, 70.0, 89.5, 149.99, 150.0, 199.5, 200.0]).tolist() == [
+        GLU_VERY_LOW, GLU_LOW, GLU_LOW, GLU_IN_RANGE, GLU_HIGH, GLU_HIGH, GLU_VERY_HIGH
+    ]
+
+
+def test_range_percentages_and_excursions():
+    values = [69, 70, 90, 150, 200, 500, 120, 130]
+    pct = range_percentages(values)
+    assert pct == {GLU_VERY_LOW: 12.5, GLU_LOW: 12.5, GLU_IN_RANGE: 37.5, GLU_HIGH: 12.5, GLU_VERY_HIGH: 25.0}
+    assert sum(range_percentages([]).values()) == 0
+
+    starts, lengths = excursion_runs(out_of_range_mask(values, VAL_CURRENT))
+    assert starts.tolist() == [0, 3] and lengths.tolist() == [2, 3]
@@ -0,0 +1,85 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+from config.utils import IDATA_TABLE_NAME, UPDATES_DATA_TABLE, INSULIN_EVENTS_TABLE, ROLLUPS_TABLE, TIMESTAMP_FORMAT, \
+    to_epoch_minutes
+from datastore.migrations import SCHEMA_VERSION
+from datastore.primitives import SqliteDatabase, fts_match_query
+
+START = datetime(2025, 3, 1, 7, 0)
+N_READINGS = 6 * 60
+
+
+def _ts(minutes: int) -> str:
+    return datetime.strftime(START + timedelta(minutes=minutes), TIMESTAMP_FORMAT)
+
+
+def create_legacy_db(data_dir: str, db_filename: str = "igloo-database.sqlite"):
+    """A database the way the original populator and record_insu left it, text timestamps and spread insulin."""
+    conn = sqlite3.connect(f"{data_dir}/{db_filename}")
+    conn.execute(f'''
+        CREATE TABLE {IDATA_TABLE_NAME} (
+            timestamp TEXT PRIMARY KEY,
+            reading_now INT,
+            reading_20 REAL,
+            velocity REAL
+        );''')
+    conn.execute(f'''
+        CREATE TABLE {UPDATES_DATA_TABLE} (
+            timestamp TEXT PRIMARY KEY,
+            ins_units INT DEFAULT 0,
+            food_note TEXT,
+            misc_note TEXT
+        );''')
+    conn.executemany(f"INSERT INTO {IDATA_TABLE_NAME} VALUES (?, ?, ?, ?);",
+                     [(_ts(i), 100 + i % 50, 110.0, 0.5) for i in range(N_READINGS)])
+    # 4u at 08:00 and 2u at 09:00, each added to the next 120 rows by the old record_insu
+    insulin = {}
+    for dose_min, units in ((60, 4), (120, 2)):
+        for i in range(dose_min, dose_min + 120):
+            insulin[i] = insulin.get(i, 0) + units
+    notes = {60: ("toast", ""), 200: ("rice and dal", "walk")}
+    for i in sorted(set(insulin) | set(notes)):
+        food_note, misc_note = notes.get(i, ("", ""))
+        conn.execute(f"INSERT INTO {UPDATES_DATA_TABLE} VALUES (?, ?, ?, ?);",
+                     (_ts(i), insulin.get(i, 0), food_note, misc_note))
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_database_is_migrated_to_the_latest_schema(tmp_path):
+    create_legacy_db(str(tmp_path))
+    sqldb = SqliteDatabase(data_dir=str(tmp_path))
+
+    def scalar(query):
+        return sqldb.execute_query(query).fetchone()[0]
+
+    assert scalar("PRAGMA user_version;") == SCHEMA_VERSION == 4
+
+    # v1, the spread rows are turned back into one event per dose, rows that only carried insulin are gone
+    events = sqldb.execute_query(f"SELECT timestamp, units FROM {INSULIN_EVENTS_TABLE} ORDER BY timestamp;").fetchall()
+    assert events == [(to_epoch_minutes(START + timedelta(minutes=60)), 4),
+                      (to_epoch_minutes(START + timedelta(minutes=120)), 2)]
+    assert scalar(f"SELECT count(*) FROM {UPDATES_DATA_TABLE};") == 2
+    assert scalar(f"SELECT count(*) FROM {UPDATES_DATA_TABLE} WHERE ins_units != 0;") == 0
+
+    # v2, every timestamp is an integer epoch minute and no reading is lost
+    assert scalar(f"SELECT count(*) FROM {IDATA_TABLE_NAME};") == N_READINGS
+    for table in (IDATA_TABLE_NAME, UPDATES_DATA_TABLE, INSULIN_EVENTS_TABLE):
+        assert scalar(f"SELECT count(*) FROM {table} WHERE typeof(timestamp) != 'integer';") == 0
+    assert scalar(f"SELECT min(timestamp) FROM {IDATA_TABLE_NAME};") == to_epoch_minutes(START)
+    assert sqldb.main_table.fetch_latest_timestamp() == START + timedelta(minutes=N_READINGS - 1)
+
+    # v3, notes written before the index existed are searchable
+    assert sqldb.updates_table.search(fts_match_query("dal")) == [
+        (to_epoch_minutes(START + timedelta(minutes=200)), "rice and dal", "walk")
+    ]
+
+    # v4, the rollups cover every reading at every resolution
+    assert sqldb.execute_query(f"SELECT resolution, sum(count) FROM {ROLLUPS_TABLE} GROUP BY resolution;").fetchall() \
+        == [(5, N_READINGS), (60, N_READINGS), (24 * 60, N_READINGS)]
+
+
+def test_new_database_starts_at_the_latest_schema(tmp_path):
+    sqldb = SqliteDatabase(data_dir=str(tmp_path))
+    assert sqldb.execute_query("PRAGMA user_version;").fetchone()[0] == SCHEMA_VERSION